@@ -1,46 +1,54 @@
 import os
-from email.message import EmailMessage
-from smtplib import SMTP, SMTPException
+import shutil
 
 import pyotp
-import requests
 from dotenv import dotenv_values
-from flask import Flask, request, jsonify, render_template, flash, url_for, redirect, send_from_directory
-from sqlalchemy import desc
+from flask import Flask, request, jsonify, render_template, stream_template, flash, url_for, redirect, \
+    send_from_directory, send_file, Response, stream_with_context
 from werkzeug.utils import secure_filename
 from flask_cors import CORS
 
+import http_client
+import metrics
+import otp_store
+import search
+import status_feed
 from image import prepare_linkedin_image
-from models import SessionLocal, PostRecord, OTPRecord
-from posts_db import create_post, get_all_posts, get_post, update_post, delete_post
+from image_cache import save_upload, prepared_base, write_prepared, get_cache
+from image_batch import new_batch_dir, extract_zip, submit_batch, batches, prepare_renditions, start_batch_purger, \
+    ENABLE_IMAGE_RENDITIONS
+from outbox import enqueue_mail, start_sender
+from models import SessionLocal, PostRecord, db_session, init_app
+from posts_db import create_post, get_all_posts, get_post, update_post, delete_post, search_posts
+from posts_bulk import import_posts, export_posts
 from logger import logger
 
 config = dotenv_values('.env')
 
+# browsers keep prepared images this long without asking again; links carry the file's mtime (?v=),
+# so an image prepared again under the same name gets a new URL
+IMAGE_CACHE_MAX_AGE = int(config.get('IMAGE_CACHE_MAX_AGE', 7 * 24 * 3600))
+
 def allowed_file(filename):
     return '.' in filename and \
         filename.rsplit('.', 1)[1].lower() in config['ALLOWED_EXTENSIONS'].split(',')
 
+def viewfile_url(name):
+    mtime = int(os.path.getmtime(os.path.join(app.config['UPLOAD_FOLDER'], name)))
+    return url_for('viewfile', name=name, v=mtime)
+
 def generate_otp():
     totp = pyotp.TOTP(config['OTP_PRIVATE_KEY'])
     return int(totp.now())
 
 
 def verify(task_id, code):
-    session = SessionLocal()
-    record = session.query(OTPRecord).filter_by(task_id=task_id).order_by(desc('timestamp')).order_by(
-        desc('id')).first()
-    print(f"OTP is {record.code}")
-    if (not record) or (record.code != code):
-        session.close()
-        return False
-    else:
-        session.close()
-        return True
+    # expired, already used or too often guessed codes all fail
+    return otp_store.store.verify(task_id, code)
 
 
 def retrieve_post(task_id, full=False):
-    session = SessionLocal()
+    session = db_session()
     record = session.query(PostRecord).filter_by(id=int(task_id)).first()
     if not record:
         session.close()
@@ -53,39 +61,22 @@ def get_config_state(flag):
     return 'ENABLED' if flag == 'True' else 'DISABLED'
 
 
-# noinspection PyBroadException
 def queue_new_post(task_id):
-    try:
-        res = requests.post(f"{config['LLM_SERVICE']}/process-new-task", json={"task_id": task_id})
-        if res.status_code != 200:
-            print(f"Failed to queue new post: RES/{res.status_code}")
-            return False
-    except Exception as e:
-        print(f"Failed to queue new post: EXP/{e}")
+    if config.get('ENABLE_CLAIM_WORKERS') == 'True':
+        # the approved row itself is the queue, a generation worker claims it from the database
+        return True
+
+    # an unreachable llm service is retried from the outbox, only a rejected task is an error
+    result = http_client.post_with_outbox(f"{config['LLM_SERVICE']}/process-new-task", {"task_id": task_id})
+    if result == "rejected":
+        print(f"Failed to queue new post: {task_id}")
         return False
     return True
 
 
 def send_mail(content, subject, to_addr, from_addr):
-    msg = EmailMessage()
-    msg.set_content(content)
-    msg['Subject'] = subject
-    msg['From'] = from_addr
-    msg['To'] = to_addr
-
-    try:
-        with SMTP(host=config['EMAIL_SERVER'], port=int(config['EMAIL_PORT'])) as s:
-            s.starttls()
-            s.login(config['EMAIL_USER'], config['EMAIL_PASSWORD'])
-            s.sendmail(config['EMAIL_USER'], config['EMAIL_USER'], msg.as_string())
-    except SMTPException as e:
-        print("failed to send email: ", e)
-        return False
-    except Exception as e:
-        print("failed to proceed: ", e)
-        return False
-    else:
-        return True
+    # only queued here, the outbox sender delivers it in the background over a pooled SMTP connection
+    return enqueue_mail(content, subject, to_addr, from_addr)
 
 
 def request_new_post(task_id):
@@ -101,6 +92,12 @@ def request_new_post(task_id):
 app = Flask(__name__)
 CORS(app,supports_credentials=True, resources={r"/api/*": {"origins": "http://localhost:3001"}})
 app.config['UPLOAD_FOLDER'] = config['UPLOAD_FOLDER']
+init_app(app)
+metrics.init_app(app, "app")
+start_sender()
+otp_store.start_purger()
+start_batch_purger(app.config['UPLOAD_FOLDER'])
+http_client.start_outbox_worker()
 
 
 @app.route('/')
@@ -146,11 +143,13 @@ def request_new_post_init():
         status="queued"
     )
 
-    session = SessionLocal()
+    session = db_session()
     session.add(record)
     session.commit()
     task_id = record.id
     session.close()
+    search.index_post(task_id)
+    metrics.record_stage(task_id, "requested")
 
     ok = request_new_post(int(task_id))
     if not ok:
@@ -171,14 +170,7 @@ def request_new_post_init():
 def init_approve(task_id):
     # gen code / return html to input code
     code = generate_otp()
-    record = OTPRecord(
-        code=code,
-        task_id=task_id,
-    )
-    session = SessionLocal()
-    session.add(record)
-    session.commit()
-    session.close()
+    otp_store.store.issue(task_id, code)
 
     ok = send_mail(
         f"Approval OTP: {code}",
@@ -195,7 +187,7 @@ def init_approve(task_id):
 @app.route("/approve/<int:task_id>", methods=["POST"])
 def approve(task_id):
     code = int(request.form['otp'])
-    print(f"Approval request for {task_id}: {code}")
+    print(f"Approval request for {task_id}")
     ok = verify(task_id, code)
     if not ok:
         return jsonify({"status": "failed"}), 403
@@ -209,7 +201,7 @@ def new_post():
     form = request.form
     print(f"new post form: {form}")
     task_id = form['id']
-    session = SessionLocal()
+    session = db_session()
     post = session.query(PostRecord).filter_by(id=task_id).first()
 
     if config['ENABLE_NEW_POST'] == 'False':
@@ -227,6 +219,9 @@ def new_post():
         post.status = "approved"
 
         session.commit()
+        search.index_post(post)
+        status_feed.publish(int(task_id), "approved")
+        metrics.record_stage(task_id, "approved")
 
     ok = queue_new_post(task_id)
     if not ok:
@@ -240,7 +235,14 @@ def new_post():
 @app.route("/webhook/update-post-status", methods=['POST'])
 def update_post_status():
     task_id = request.json['task_id']
-    print("new post update: ", task_id)
+    status = request.json.get('status', 'done')
+    print("new post update: ", task_id, status)
+    status_feed.publish(int(task_id), status)
+    metrics.record_stage(task_id, "notified")
+    # the llm service wrote the generated text straight to the table
+    search.index_post(int(task_id))
+    if status != 'done':
+        return jsonify({"status": "success"}), 200
     data = retrieve_post(task_id)
     if not data:
         print(f"Failed to retrieve task data: {task_id}")
@@ -265,10 +267,14 @@ def update_post_status():
 
 @app.route('/posts', methods=['GET'])
 def old_get_posts():
-    session = SessionLocal()
-    posts = session.query(PostRecord).all()
+    def posts():
+        session = SessionLocal()
+        try:
+            yield from session.query(PostRecord).order_by(PostRecord.id).yield_per(500)
+        finally:
+            session.close()
 
-    return render_template('posts.html', posts=posts)
+    return stream_template('posts.html', posts=posts())
 
 
 @app.route('/prep-images', methods=['GET', 'POST'])
@@ -287,23 +293,100 @@ def prep_images():
         return render_template('prep-images.html')
 
     if file and allowed_file(file.filename):
-        filenames = secure_filename(file.filename).split('.')
-        filename, ext = filenames[0], filenames[1]
+        ext = file.filename.rsplit('.', 1)[1].lower()
+        folder = app.config['UPLOAD_FOLDER']
+        caption = request.form['caption']
+
+        # stored under its content hash, the same photo with the same caption is only prepared once
+        digest, filepath = save_upload(file, folder, ext)
+        base = prepared_base(digest, caption, ENABLE_IMAGE_RENDITIONS)
+        name = base + ("-linkedin.jpg" if ENABLE_IMAGE_RENDITIONS else "." + ext)
+        print(f"upload: {filepath}\n prepared: {name}")
+        if get_cache(folder).hit(base, name):
+            metrics.image_cache_lookups.inc(result="hit")
+            return redirect(viewfile_url(name))
+        metrics.image_cache_lookups.inc(result="miss")
+
+        def write(output_base):
+            if ENABLE_IMAGE_RENDITIONS:
+                return prepare_renditions(filepath, output_base, caption)
+            prepare_linkedin_image(filepath, f"{output_base}.{ext}", caption)
+            return [f"{output_base}.{ext}"]
+
+        with metrics.image_prep.time(mode="renditions" if ENABLE_IMAGE_RENDITIONS else "single"):
+            write_prepared(folder, base, write)
+        return redirect(viewfile_url(name))
 
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename + "." + ext)
-        edit_filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename + "-prep." + ext)
-        print(f"filename: {filepath}\n edit filepath: {edit_filepath}")
+    return 'Something went wrong.'
 
-        file.save(filepath)
-        prepare_linkedin_image(filepath, edit_filepath, request.form['caption'])
-        return redirect(url_for('viewfile', name=filename + "-prep." + ext))
 
-    return 'Something went wrong.'
+@app.route('/prep-images/batch', methods=['POST'])
+def prep_images_batch():
+    # many images and/or zip archives; `captions` (one per file, optional) override `caption`
+    files = request.files.getlist('files') or request.files.getlist('file')
+    captions = request.form.getlist('captions')
+    caption = request.form.get('caption', '')
+
+    batch_id, batch_dir = new_batch_dir(app.config['UPLOAD_FOLDER'])
+    in_dir = os.path.join(batch_dir, 'in')
+    items = []
+    for index, file in enumerate(files):
+        filename = secure_filename(file.filename or '')
+        if not filename:
+            continue
+
+        file_caption = captions[index] if index < len(captions) and captions[index] else None
+        filepath = os.path.join(in_dir, str(index), filename)
+        os.makedirs(os.path.dirname(filepath))
+        file.save(filepath)
+        if filename.lower().endswith('.zip'):
+            try:
+                zip_items = extract_zip(filepath, in_dir)
+            except ValueError as e:
+                shutil.rmtree(batch_dir, ignore_errors=True)
+                return jsonify({'error': str(e)}), 400
+            items += [(path, zip_caption or file_caption) for path, zip_caption in zip_items]
+        elif allowed_file(filename):
+            items.append((filepath, file_caption))
+
+    if not items:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+        return jsonify({'error': 'No images in request'}), 400
+
+    batch = submit_batch(batch_id, batch_dir, items, caption)
+    logger.info(f"PREP IMAGES BATCH({batch_id}): {len(items)} images")
+    return jsonify({
+        **batch.dict(),
+        'status_url': url_for('prep_images_batch_status', batch_id=batch_id),
+        'download_url': url_for('prep_images_batch_download', batch_id=batch_id),
+    }), 202
+
+
+@app.route('/prep-images/batch/<batch_id>')
+def prep_images_batch_status(batch_id):
+    batch = batches.get(batch_id)
+    if not batch:
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify(batch.dict())
+
+
+@app.route('/prep-images/batch/<batch_id>/download')
+def prep_images_batch_download(batch_id):
+    batch = batches.get(batch_id)
+    if not batch:
+        return jsonify({'error': 'Not found'}), 404
+    if batch.status != 'done':
+        return jsonify(batch.dict()), 409
+    return send_file(batch.zip_path, mimetype='application/zip', as_attachment=True,
+                     download_name=f"prepared-{batch_id}.zip")
 
 
 @app.route('/viewfile/<name>')
 def viewfile(name):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], name)
+    # ETag/Last-Modified come from send_from_directory, which also answers conditional requests with 304
+    response = send_from_directory(app.config['UPLOAD_FOLDER'], name, max_age=IMAGE_CACHE_MAX_AGE)
+    response.cache_control.public = True
+    return response
 
 # ======================== CHANGE TO NEW ARCHITECTURE: API+SPA ====================================
 @app.route('/api/posts', methods=['POST'])
@@ -314,12 +397,85 @@ def api_create_post():
 @app.route('/api/posts', methods=['GET'])
 def api_read_all_posts():
     logger.info('READ POSTS(ALL)')
-    return get_all_posts()
+    return get_all_posts(request)
+
+@app.route('/api/posts/import', methods=['POST'])
+def api_import_posts():
+    logger.info('IMPORT POSTS')
+    return import_posts(request)
+
+@app.route('/api/posts/export', methods=['GET'])
+def api_export_posts():
+    logger.info('EXPORT POSTS')
+    return export_posts(request.args)
+
+@app.route('/api/posts/search', methods=['GET'])
+def api_search_posts():
+    logger.info(f"SEARCH POSTS({request.args.get('q')})")
+    return search_posts(request.args)
 
 @app.route('/api/posts/<int:id>', methods=['GET'])
 def api_get_post(id):
     logger.info(f"READ POSTS({id})")
-    return get_post(id)
+    return get_post(request, id)
+
+@app.route('/api/posts/<int:id>/stream', methods=['GET'])
+def api_stream_post(id):
+    logger.info(f"STREAM POST({id})")
+    try:
+        # read timeout only has to outlive the keep-alive comments of the llm service
+        res = http_client.get(f"{config['LLM_SERVICE']}/stream/{id}", stream=True,
+                              timeout=(http_client.HTTP_CONNECT_TIMEOUT, 60))
+    except Exception as e:
+        logger.error(f"STREAM POST({id}): {e}")
+        return jsonify({'error': 'Generation service unavailable'}), 502
+
+    if res.status_code != 200:
+        res.close()
+        return jsonify({'error': 'Not generating'}), 404
+
+    def relay():
+        try:
+            yield from res.iter_content(chunk_size=None)
+        finally:
+            res.close()
+
+    return Response(stream_with_context(relay()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/api/posts/<int:id>/status', methods=['GET'])
+def api_post_status(id):
+    # long-poll: answers once the status differs from `known`, or after `wait` seconds with the current one
+    wait = min(request.args.get('wait', 30, type=float), 60)
+    status = status_feed.wait_for_change(id, request.args.get('known'), wait)
+    if status is None:
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify({'task_id': id, 'status': status})
+
+@app.route('/api/posts/<int:id>/status/events', methods=['GET'])
+def api_post_status_events(id):
+    if status_feed.get_task(id) is None:
+        return jsonify({'error': 'Not found'}), 404
+    return Response(stream_with_context(status_feed.events(id)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+@app.route('/api/posts/<int:id>/trace', methods=['GET'])
+def api_trace_post(id):
+    # when the task reached each stage, to see where a slow post spent its time
+    return jsonify(metrics.task_trace(id))
+
+
+@app.route('/api/posts/<int:id>/cancel', methods=['POST'])
+def api_cancel_post(id):
+    logger.info(f"CANCEL POST({id})")
+    try:
+        res = http_client.post(f"{config['LLM_SERVICE']}/cancel/{id}")
+    except Exception as e:
+        logger.error(f"CANCEL POST({id}): {e}")
+        return jsonify({'error': 'Generation service unavailable'}), 502
+
+    if res.status_code != 200:
+        return jsonify({'error': 'Not generating'}), 404
+    return jsonify({'message': 'Cancelled'})
 
 if __name__ == '__main__':
     DEBUG = config['ENABLE_DEBUG'] == 'True'
@@ -0,0 +1,102 @@
+"""Compare INFERENCE_MODE options by decode speed and peak memory.
+
+    python bench/inference_modes.py --model Qwen/Qwen2.5-0.5B-Instruct --modes fp32,bf16,int8,bf16+compile
+
+Every mode runs in its own subprocess so the peak RSS of one mode does not leak into the next.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SAMPLE_PROMPT = """
+Write a LinkedIn post about my company Inecosys participation in an event. The Post SHOULD NOT exceed 200 words.
+include 3 hashtags at the very bottom as well.
+
+Title: Bauma 2025 Muenchen
+Event Date: 2025-04-07
+Description: Trade fair for construction machinery, we presented our digital site logistics platform.
+Positive Impressions: many visitors from mid-sized construction companies
+Possible improvements: booth was hard to find
+Goal of Participation: generate leads and meet partners
+
+Post:
+"""
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_mode(model_name, device, mode, new_tokens, batch_size):
+    import torch
+    from transformers import AutoTokenizer
+    from inference import load_model
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    started = time.perf_counter()
+    model = load_model(model_name, device, mode.replace("+", ","))
+    load_seconds = time.perf_counter() - started
+
+    encoded = tokenizer([SAMPLE_PROMPT] * batch_size, return_tensors="pt", padding=True).to(device)
+    generate_args = dict(min_new_tokens=new_tokens, max_new_tokens=new_tokens, do_sample=False,
+                         pad_token_id=tokenizer.pad_token_id)
+    with torch.inference_mode():
+        # warm-up, compile modes do their tracing here
+        model.generate(**encoded, **dict(generate_args, min_new_tokens=4, max_new_tokens=4))
+        started = time.perf_counter()
+        model.generate(**encoded, **generate_args)
+        seconds = time.perf_counter() - started
+
+    return {
+        "mode": mode,
+        "load_seconds": round(load_seconds, 2),
+        "generate_seconds": round(seconds, 2),
+        "tokens_per_second": round(new_tokens * batch_size / seconds, 2),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", required=True)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--modes", default="fp32,bf16,int8", help="comma separated, combine options with +")
+    parser.add_argument("--new-tokens", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--single", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        print(json.dumps(run_mode(args.model, args.device, args.single, args.new_tokens, args.batch_size)))
+        return
+
+    results = []
+    for mode in args.modes.split(","):
+        cmd = [sys.executable, os.path.abspath(__file__), "--model", args.model, "--device", args.device,
+               "--new-tokens", str(args.new_tokens), "--batch-size", str(args.batch_size), "--single", mode]
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(f"{mode}: failed\n{proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else ''}")
+            continue
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        results.append(result)
+        print(f"{mode:>16}: {result['tokens_per_second']:8.2f} tok/s  {result['peak_rss_mb']:8.1f} MB peak RSS  "
+              f"(load {result['load_seconds']}s)")
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,361 @@
+"""Benchmark suite for the post pipeline.
+
+    python bench/run.py                                   # everything, 10k posts
+    python bench/run.py --only api_posts --rows 1000000   # one benchmark, bigger table
+    python bench/run.py --model ./models/tiny-llama       # include real inference with a small local model
+    python bench/run.py --compare bench/results/abc1234.json
+
+Every run works in a throw-away directory with its own .env and SQLite database, so it never touches
+the real configuration. Results are written as JSON (default bench/results/<commit>.json); with
+--compare, medians that got slower than --threshold are reported and the exit code is 1.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = ("image_prep", "api_posts", "otp_verify", "end_to_end", "inference")
+IMAGE_SIZES = ((1280, 960), (4000, 3000), (6000, 4000))
+
+ENV = """DATABASE_URI=sqlite:///{dir}/bench.db
+UPLOAD_FOLDER={dir}/uploads
+ALLOWED_EXTENSIONS=jpg,jpeg,png
+INFERENCE_DEVICE=cpu
+MODEL_NAME={model}
+ENABLE_LLM_GENERATION=False
+ENABLE_SCHEDULED_GENERATION=True
+ENABLE_NEW_POST=True
+ENABLE_EMAIL=False
+ENABLE_DEBUG=False
+APP_SERVICE=http://127.0.0.1:{app_port}
+LLM_SERVICE=http://127.0.0.1:{llm_port}
+OTP_PRIVATE_KEY=JBSWY3DPEHPK3PXP
+EMAIL_SERVER=127.0.0.1
+EMAIL_PORT=9
+EMAIL_USER=bench@localhost
+MARKETING_LEITER_EMAIL_ADDRESS=bench@localhost
+MAIL_POLL_SECONDS=3600
+LLM_DISABLED_DELAY_SECONDS=0
+BATCH_WINDOW_SECONDS=0.05
+"""
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return summarize(samples)
+
+
+def summarize(samples_ms):
+    samples_ms = sorted(samples_ms)
+    return {
+        "median_ms": round(statistics.median(samples_ms), 3),
+        "p95_ms": round(samples_ms[min(len(samples_ms) - 1, int(len(samples_ms) * 0.95))], 3),
+        "runs": len(samples_ms),
+    }
+
+
+def free_port():
+    import socket
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve(flask_app, port):
+    from werkzeug.serving import make_server
+    server = make_server("127.0.0.1", port, flask_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_image_prep(args, work_dir):
+    from PIL import Image, ImageDraw
+    from image import prepare_linkedin_image, prepare_linkedin_renditions
+
+    if not os.path.exists(args.font):
+        return {"skipped": f"font {args.font} not found, pass --font"}
+
+    results = {}
+    for w, h in IMAGE_SIZES:
+        source = os.path.join(work_dir, f"source-{w}x{h}.jpg")
+        img = Image.new("RGB", (w, h), "white")
+        draw = ImageDraw.Draw(img)
+        for x in range(0, w, 40):
+            draw.line([(x, 0), (w - x, h)], fill=(x % 255, 120, 200), width=7)
+        img.save(source, quality=90)
+
+        results[f"{w}x{h}"] = {
+            "full": timed(lambda: prepare_linkedin_image(source, os.path.join(work_dir, "out.jpg"), "Benchmark",
+                                                         font_path=args.font), args.repeat),
+            "renditions": timed(lambda: prepare_linkedin_renditions(source, os.path.join(work_dir, "out"),
+                                                                    "Benchmark", font_path=args.font), args.repeat),
+        }
+    return results
+
+
+def seed_posts(rows):
+    from sqlalchemy import insert
+    from models import SessionLocal, PostRecord
+
+    session = SessionLocal()
+    chunk = []
+    for i in range(rows):
+        chunk.append({
+            "event_title": f"Event {i}",
+            "date": "2025-04-07",
+            "description": "Trade fair for construction machinery. " * 4,
+            "good": "many visitors",
+            "bad": "booth was hard to find",
+            "goal": "leads",
+            "instructions": "",
+            "post": "We had a great time at the fair. #inecosys #bauma #construction" if i % 3 else None,
+            "status": ("queued", "approved", "done")[i % 3],
+            "posttype": ("regular", "messe", "ILP")[i % 3],
+        })
+        if len(chunk) == 10000:
+            session.execute(insert(PostRecord), chunk)
+            chunk = []
+    if chunk:
+        session.execute(insert(PostRecord), chunk)
+    session.commit()
+    session.close()
+
+
+def bench_api_posts(args, work_dir):
+    import app
+
+    client = app.app.test_client()
+    started = time.perf_counter()
+    seed_posts(args.rows)
+    seed_seconds = time.perf_counter() - started
+
+    middle = args.rows // 2
+    results = {
+        "rows": args.rows,
+        "seed_seconds": round(seed_seconds, 2),
+        "first_page": timed(lambda: client.get("/api/posts?limit=50"), args.repeat),
+        "middle_page": timed(lambda: client.get(f"/api/posts?limit=50&cursor={middle}"), args.repeat),
+        "filtered_page": timed(lambda: client.get(f"/api/posts?limit=50&status=done&cursor={middle}"), args.repeat),
+        "projected_page": timed(lambda: client.get("/api/posts?limit=500&fields=event_title,status"), args.repeat),
+        "get_one": timed(lambda: client.get(f"/api/posts/{middle}"), args.repeat),
+    }
+
+    started = time.perf_counter()
+    body = client.get("/api/posts?fields=event_title,status").get_data()
+    results["full_export"] = {"seconds": round(time.perf_counter() - started, 3), "bytes": len(body)}
+
+    creates = max(args.repeat * 10, 100)
+    payload = {"event_title": "Created", "date": "2025-01-01", "description": "bench", "good": "", "bad": "",
+               "goal": "", "instructions": ""}
+    started = time.perf_counter()
+    for _ in range(creates):
+        client.post("/api/posts", json=payload)
+    results["create_per_second"] = round(creates / (time.perf_counter() - started), 1)
+    return results
+
+
+def bench_otp_verify(args, work_dir):
+    from sqlalchemy import insert
+    import otp_store
+    from models import SessionLocal, OTPRecord
+
+    # history of other tasks the sql store has to look past
+    history = args.otp_rows
+    session = SessionLocal()
+    now = datetime.datetime.now()
+    for start in range(0, history, 10000):
+        session.execute(insert(OTPRecord), [
+            {"code": 100000 + i % 900000, "task_id": i % 5000, "timestamp": now - datetime.timedelta(seconds=i)}
+            for i in range(start, min(history, start + 10000))
+        ])
+    session.commit()
+    session.close()
+
+    results = {"otp_rows": history}
+    stores = {"memory": otp_store.KeyValueOTPStore(otp_store.TTLMap()), "sql": otp_store.SqlOTPStore()}
+    for name, store in stores.items():
+        # codes are single use, every run issues a fresh one for a task of its own
+        task_ids = iter(range(10 ** 6, 2 * 10 ** 6))
+
+        def issue_and_verify():
+            task_id = next(task_ids)
+            store.issue(task_id, 424242)
+            if not store.verify(task_id, 424242):
+                raise RuntimeError(f"{name} OTP store rejected a freshly issued code")
+
+        results[name] = {"issue_verify": timed(issue_and_verify, args.repeat)}
+    return results
+
+
+def bench_end_to_end(args, work_dir, ports):
+    import app
+    import llm
+    from models import SessionLocal, PostRecord
+
+    servers = [serve(app.app, ports["app"]), serve(llm.llm, ports["llm"])]
+    client = app.app.test_client()
+    form = {"event_title": "E2E", "date": "2025-04-07", "description": "d", "good": "g", "bad": "b", "goal": "x"}
+
+    def run_once():
+        client.post("/request-new-post", data=form)
+        session = SessionLocal()
+        task_id = session.query(PostRecord.id).order_by(PostRecord.id.desc()).first()[0]
+        session.close()
+
+        client.get(f"/init-approve/{task_id}")
+        client.post(f"/approve/{task_id}", data={"otp": app.generate_otp()})
+        client.post("/queue-new-post", data={**form, "id": task_id, "instructions": ""})
+
+        deadline = time.perf_counter() + 60
+        while time.perf_counter() < deadline:
+            session = SessionLocal()
+            status = session.query(PostRecord.status).filter_by(id=task_id).scalar()
+            session.close()
+            if status in ("done", "failed"):
+                return
+            time.sleep(0.01)
+        raise TimeoutError(f"task {task_id} did not finish")
+
+    try:
+        return {"request_to_done": timed(run_once, args.repeat)}
+    finally:
+        for server in servers:
+            server.shutdown()
+
+
+def bench_inference(args, work_dir):
+    if not args.model:
+        return {"skipped": "no --model given"}
+
+    import torch
+    from inference import Engine
+    from llm import PROMPT_PREFIX, make_prompt
+
+    engine = Engine(args.model, "cpu", args.inference_mode, PROMPT_PREFIX)
+    inputs = {"event_title": "Bauma 2025", "date": "2025-04-07", "description": "Trade fair", "good": "visitors",
+              "bad": "booth location", "goal": "leads", "instructions": ""}
+    results = {}
+    for batch in (1, 4):
+        prompts = [make_prompt(**inputs)] * batch
+
+        def generate():
+            with torch.inference_mode():
+                engine.model.generate(**engine.encode(prompts), min_new_tokens=args.new_tokens,
+                                      max_new_tokens=args.new_tokens, do_sample=False,
+                                      pad_token_id=engine.tokenizer.pad_token_id)
+
+        generate()  # warm-up
+        summary = timed(generate, max(1, args.repeat // 5))
+        summary["tokens_per_second"] = round(args.new_tokens * batch / (summary["median_ms"] / 1000), 2)
+        results[f"batch_{batch}"] = summary
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def medians(results, prefix=""):
+    # flattens {"a": {"b": {"median_ms": 1}}} to {"a.b": 1}
+    found = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            if "median_ms" in value:
+                found[prefix + key] = value["median_ms"]
+            else:
+                found.update(medians(value, f"{prefix}{key}."))
+    return found
+
+
+def compare(current, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    regressions = []
+    old, new = medians(baseline["results"]), medians(current["results"])
+    print(f"\ncompared with {baseline.get('commit')} ({baseline_path}):")
+    for name in sorted(set(old) & set(new)):
+        change = (new[name] - old[name]) / old[name] if old[name] else 0
+        flag = "  REGRESSION" if change > threshold else ""
+        print(f"  {name:<45} {old[name]:>10.3f} -> {new[name]:>10.3f} ms ({change:+.1%}){flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", help=f"comma separated subset of {', '.join(BENCHMARKS)}")
+    parser.add_argument("--rows", type=int, default=10000, help="posts in the table for api_posts")
+    parser.add_argument("--otp-rows", type=int, default=100000, help="OTP history for otp_verify")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--font", default=os.path.join(REPO, "fend", "jetbrains.ttf"))
+    parser.add_argument("--model", help="small local model for the inference benchmark")
+    parser.add_argument("--inference-mode", default="")
+    parser.add_argument("--new-tokens", type=int, default=32)
+    parser.add_argument("--output", help="result file, default bench/results/<commit>.json")
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown before flagging")
+    args = parser.parse_args()
+
+    selected = args.only.split(",") if args.only else BENCHMARKS
+    commit = git_commit()
+    output = os.path.abspath(args.output or os.path.join(REPO, "bench", "results", f"{commit}.json"))
+    baseline = os.path.abspath(args.compare) if args.compare else None
+    args.font = os.path.abspath(args.font)
+
+    work_dir = tempfile.mkdtemp(prefix="inecosys-bench-")
+    ports = {"app": free_port(), "llm": free_port()}
+    os.makedirs(os.path.join(work_dir, "uploads"))
+    with open(os.path.join(work_dir, ".env"), "w") as f:
+        f.write(ENV.format(dir=work_dir, model=args.model or "none", app_port=ports["app"], llm_port=ports["llm"]))
+    # every module reads ./.env at import time
+    os.chdir(work_dir)
+    sys.path.insert(0, REPO)
+
+    import models
+    models.migrate()
+
+    results = {}
+    for name in selected:
+        print(f"running {name}...")
+        runner = globals()[f"bench_{name}"]
+        results[name] = runner(args, work_dir, ports) if name == "end_to_end" else runner(args, work_dir)
+
+    report = {
+        "commit": commit,
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"results written to {output}")
+
+    if baseline and compare(report, baseline, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
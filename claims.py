@@ -0,0 +1,290 @@
+"""Generation workers that claim approved posts from the shared database instead of being sent them.
+
+Every process running start() polls for `approved` rows, claims them atomically and holds a lease
+on each while it generates, renewed by a heartbeat. A worker that dies stops renewing; once its
+lease has expired another worker claims the row again. Postgres claims with
+SELECT ... FOR UPDATE SKIP LOCKED, other databases (SQLite) with a compare-and-set UPDATE per row.
+
+Tasks handed out over /process-new-task (jobs.py) are leased the same way, but only by the process
+that runs their job (acquire()); while a job waits, its task carries a reservation without an owner,
+which any process that picks the job up from the shared `generation_jobs` table may take. The
+two modes are exclusive: with ENABLE_CLAIM_WORKERS the durable job scheduler is not started.
+
+A task whose worker died while generating it (an out-of-memory crash, say) is retried until it used
+up CLAIM_MAX_ATTEMPTS and then marked failed, so one task cannot take down every worker in turn.
+"""
+import datetime
+import os
+import socket
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+
+from dotenv import dotenv_values
+from sqlalchemy import update, func, or_, and_
+
+from models import engine, SessionLocal, PostRecord
+
+config = dotenv_values(".env")
+
+CLAIM_LEASE_SECONDS = float(config.get('CLAIM_LEASE_SECONDS', 120))
+CLAIM_POLL_SECONDS = float(config.get('CLAIM_POLL_SECONDS', 2))
+CLAIM_MAX_ATTEMPTS = int(config.get('CLAIM_MAX_ATTEMPTS', 4))
+CLAIM_RETRY_BACKOFF_SECONDS = float(config.get('CLAIM_RETRY_BACKOFF_SECONDS', 30))
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+inflight = set()
+inflight_lock = threading.Lock()
+handlers = {}
+heartbeat_thread = None
+
+
+def claimable(now):
+    return or_(
+        # approved rows released for a retry carry the lease as their backoff
+        and_(PostRecord.status == "approved",
+             or_(PostRecord.lease_expires_at.is_(None), PostRecord.lease_expires_at <= now)),
+        # the worker holding it stopped sending heartbeats, and it has attempts left
+        and_(PostRecord.status == "processing", PostRecord.claimed_by.isnot(None),
+             PostRecord.lease_expires_at <= now, func.coalesce(PostRecord.attempts, 0) < CLAIM_MAX_ATTEMPTS),
+    )
+
+
+def exhausted(now):
+    return and_(PostRecord.status == "processing", PostRecord.lease_expires_at <= now,
+                func.coalesce(PostRecord.attempts, 0) >= CLAIM_MAX_ATTEMPTS)
+
+
+def lease(now):
+    return {
+        "status": "processing",
+        "claimed_by": WORKER_ID,
+        "lease_expires_at": now + datetime.timedelta(seconds=CLAIM_LEASE_SECONDS),
+        "heartbeat_at": now,
+        "attempts": func.coalesce(PostRecord.attempts, 0) + 1,
+    }
+
+
+def reservation(until):
+    # waiting for a job any process may run, nobody holds it yet
+    return {"claimed_by": None, "lease_expires_at": until}
+
+
+def owned(task_id):
+    # rows taken before leases existed have no owner, a leased one may only be changed by its worker
+    return and_(PostRecord.id == task_id, or_(PostRecord.claimed_by.is_(None), PostRecord.claimed_by == WORKER_ID))
+
+
+def claim(limit):
+    """Claim up to `limit` rows for this worker; returns [(task_id, data, attempts)]."""
+    now = datetime.datetime.now()
+    session = SessionLocal()
+    try:
+        query = session.query(PostRecord.id).filter(claimable(now)).order_by(PostRecord.id).limit(limit)
+        if engine.dialect.name == "postgresql":
+            # rows locked by another worker's claim are skipped instead of waited for
+            ids = [row.id for row in query.with_for_update(skip_locked=True)]
+            if ids:
+                session.execute(update(PostRecord).where(PostRecord.id.in_(ids)).values(**lease(now)))
+        else:
+            ids = []
+            for row in query.all():
+                # compare-and-set: only one of the workers that read the row as claimable updates it
+                result = session.execute(update(PostRecord).where(PostRecord.id == row.id, claimable(now))
+                                         .values(**lease(now)))
+                if result.rowcount:
+                    ids.append(row.id)
+        session.commit()
+
+        records = session.query(PostRecord).filter(PostRecord.id.in_(ids)).order_by(PostRecord.id).all()
+        return [(record.id, record.dict(), record.attempts) for record in records]
+    finally:
+        session.close()
+
+
+def hold(task_id):
+    """Keep renewing the lease of `task_id` until drop()."""
+    with inflight_lock:
+        inflight.add(task_id)
+
+
+def drop(task_id):
+    with inflight_lock:
+        inflight.discard(task_id)
+
+
+def acquire(task_id):
+    """Lease a `processing` task to this worker before running its job; False while another live
+    worker holds it, in which case that worker is generating it already."""
+    now = datetime.datetime.now()
+    session = SessionLocal()
+    try:
+        taken = session.execute(update(PostRecord)
+                                .where(PostRecord.id == task_id, PostRecord.status == "processing",
+                                       or_(PostRecord.claimed_by.is_(None), PostRecord.claimed_by == WORKER_ID,
+                                           PostRecord.lease_expires_at.is_(None), PostRecord.lease_expires_at <= now))
+                                .values(**lease(now))).rowcount
+        session.commit()
+    finally:
+        session.close()
+    if taken:
+        hold(task_id)
+    return bool(taken)
+
+
+def reserve(task_id):
+    """Reserve a `processing` task nobody holds a lease on for a job; returns its data, or None if
+    another process holds or just reserved it."""
+    now = datetime.datetime.now()
+    session = SessionLocal()
+    try:
+        reserved = session.execute(update(PostRecord)
+                                   .where(PostRecord.id == task_id, PostRecord.status == "processing",
+                                          or_(PostRecord.lease_expires_at.is_(None),
+                                              PostRecord.lease_expires_at <= now))
+                                   .values(**reservation(now + datetime.timedelta(seconds=CLAIM_LEASE_SECONDS))))
+        session.commit()
+        return session.get(PostRecord, task_id).dict() if reserved.rowcount else None
+    finally:
+        session.close()
+
+
+def unlease(task_id, until):
+    """Give up the lease of a task whose job runs again at `until`, whoever runs it may lease it then."""
+    drop(task_id)
+    session = SessionLocal()
+    try:
+        session.execute(update(PostRecord)
+                        .where(owned(task_id), PostRecord.status == "processing")
+                        .values(**reservation(until + datetime.timedelta(seconds=CLAIM_LEASE_SECONDS))))
+        session.commit()
+    finally:
+        session.close()
+
+
+def exhausted_tasks():
+    """Tasks whose lease ran out with no attempts left, their workers died while generating them."""
+    session = SessionLocal()
+    try:
+        return [row.id for row in session.query(PostRecord.id).filter(exhausted(datetime.datetime.now()))]
+    finally:
+        session.close()
+
+
+def take_exhausted(task_id):
+    """Lease an exhausted task to this worker so it may mark it failed; False if another was faster."""
+    now = datetime.datetime.now()
+    session = SessionLocal()
+    try:
+        taken = session.execute(update(PostRecord)
+                                .where(PostRecord.id == task_id, exhausted(now))
+                                .values(claimed_by=WORKER_ID,
+                                        lease_expires_at=now + datetime.timedelta(seconds=CLAIM_LEASE_SECONDS)))
+        session.commit()
+        return bool(taken.rowcount)
+    finally:
+        session.close()
+
+
+def heartbeat():
+    """Extend the leases of the tasks this worker is generating."""
+    with inflight_lock:
+        ids = list(inflight)
+    if not ids:
+        return
+    now = datetime.datetime.now()
+    session = SessionLocal()
+    try:
+        # version/updated_at kept as they are, a heartbeat is no change of the post
+        session.execute(update(PostRecord)
+                        .where(PostRecord.id.in_(ids), PostRecord.claimed_by == WORKER_ID,
+                               PostRecord.status == "processing")
+                        .values(lease_expires_at=now + datetime.timedelta(seconds=CLAIM_LEASE_SECONDS),
+                                heartbeat_at=now, version=PostRecord.version, updated_at=PostRecord.updated_at))
+        session.commit()
+    finally:
+        session.close()
+
+
+def release(task_id, delay):
+    """Hand a failed task back as approved, claimable again by any worker after `delay` seconds."""
+    session = SessionLocal()
+    try:
+        session.execute(update(PostRecord)
+                        .where(owned(task_id), PostRecord.status == "processing")
+                        .values(status="approved", claimed_by=None,
+                                lease_expires_at=datetime.datetime.now() + datetime.timedelta(seconds=delay)))
+        session.commit()
+    finally:
+        session.close()
+
+
+def run_task(task_id, data, attempts):
+    try:
+        handlers['run'](task_id, data)
+    except Exception as e:
+        if attempts >= CLAIM_MAX_ATTEMPTS:
+            print(f"Giving up on task_id {task_id} after {attempts} attempts: EXP/{e}")
+            handlers['give_up'](task_id)
+            return
+
+        delay = CLAIM_RETRY_BACKOFF_SECONDS * 2 ** (attempts - 1)
+        print(f"Task_id {task_id} failed (attempt {attempts}), released for a retry in {delay}s: EXP/{e}")
+        release(task_id, delay)
+    finally:
+        with inflight_lock:
+            inflight.discard(task_id)
+
+
+def give_up_exhausted(on_give_up, is_pending=lambda task_id: False):
+    for task_id in exhausted_tasks():
+        if not is_pending(task_id) and take_exhausted(task_id):
+            print(f"Giving up on task_id {task_id}, its worker stopped {CLAIM_MAX_ATTEMPTS} times while running it")
+            on_give_up(task_id)
+
+
+def claim_loop(executor, capacity):
+    while True:
+        try:
+            give_up_exhausted(handlers['give_up'])
+            with inflight_lock:
+                free = capacity - len(inflight)
+            claimed = claim(free) if free > 0 else []
+            for task_id, data, attempts in claimed:
+                print(f"Claimed task_id {task_id} (attempt {attempts})")
+                with inflight_lock:
+                    inflight.add(task_id)
+                executor.submit(run_task, task_id, data, attempts)
+        except Exception as e:
+            print(f"Failed to claim tasks: EXP/{e}")
+        sleep(CLAIM_POLL_SECONDS)
+
+
+def heartbeat_loop():
+    while True:
+        sleep(CLAIM_LEASE_SECONDS / 3)
+        try:
+            heartbeat()
+        except Exception as e:
+            print(f"Failed to renew leases: EXP/{e}")
+
+
+def start_heartbeat():
+    global heartbeat_thread
+    if heartbeat_thread is None:
+        heartbeat_thread = threading.Thread(target=heartbeat_loop, name="lease-heartbeat", daemon=True)
+        heartbeat_thread.start()
+    return heartbeat_thread
+
+
+def start(handler, on_give_up, capacity):
+    """Claim and run tasks in the background; `handler(task_id, data)` runs one, `on_give_up(task_id)`
+    ends retries. At most `capacity` tasks are held at a time."""
+    handlers['run'] = handler
+    handlers['give_up'] = on_give_up
+    executor = ThreadPoolExecutor(max_workers=capacity, thread_name_prefix="claimed-task")
+    threading.Thread(target=claim_loop, args=(executor, capacity), name="claim-loop", daemon=True).start()
+    start_heartbeat()
+    print(f"Claiming approved tasks as {WORKER_ID}")
@@ -0,0 +1,109 @@
+import datetime
+import hashlib
+import json
+import threading
+
+from dotenv import dotenv_values
+
+from models import SessionLocal, GenerationCacheRecord
+
+config = dotenv_values(".env")
+
+ENABLE_GENERATION_CACHE = config.get('ENABLE_GENERATION_CACHE', 'True') == 'True'
+GENERATION_CACHE_MAX_ENTRIES = int(config.get('GENERATION_CACHE_MAX_ENTRIES', 1000))
+GENERATION_CACHE_MAX_AGE_DAYS = float(config.get('GENERATION_CACHE_MAX_AGE_DAYS', 30))
+
+stats = {"hits": 0, "misses": 0}
+stats_lock = threading.Lock()
+
+
+def normalize(value):
+    # whitespace differences from the form fields should not cause a miss
+    return " ".join(str(value or "").split())
+
+
+def cache_key(inputs, model_name, sampling, today=None):
+    payload = {
+        "inputs": {name: normalize(value) for name, value in inputs.items()},
+        "model": model_name,
+        "sampling": sampling,
+        # the prompt carries today's date for the model to pick the tense against the event date,
+        # a post written before the event must not be served after it
+        "today": (today or datetime.date.today()).isoformat(),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def count(outcome):
+    with stats_lock:
+        stats[outcome] += 1
+
+
+def lookup(key):
+    """Return the cached post for `key`, or None on a miss."""
+    if not ENABLE_GENERATION_CACHE:
+        return None
+
+    session = SessionLocal()
+    record = session.get(GenerationCacheRecord, key)
+    expired = record and record.created_at < datetime.datetime.now() - datetime.timedelta(
+        days=GENERATION_CACHE_MAX_AGE_DAYS)
+    if not record or expired:
+        if expired:
+            session.delete(record)
+            session.commit()
+        session.close()
+        count("misses")
+        return None
+
+    record.hits += 1
+    record.last_hit_at = datetime.datetime.now()
+    post = record.post
+    session.commit()
+    session.close()
+    count("hits")
+    return post
+
+
+def store(key, post):
+    if not ENABLE_GENERATION_CACHE or not post:
+        return
+
+    session = SessionLocal()
+    session.merge(GenerationCacheRecord(key=key, post=post, created_at=datetime.datetime.now(),
+                                        last_hit_at=datetime.datetime.now(), hits=0))
+    evict(session)
+    session.commit()
+    session.close()
+
+
+def evict(session):
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=GENERATION_CACHE_MAX_AGE_DAYS)
+    session.query(GenerationCacheRecord).filter(GenerationCacheRecord.created_at < cutoff).delete()
+
+    # keep the most recently used entries
+    overflow = session.query(GenerationCacheRecord.key) \
+        .order_by(GenerationCacheRecord.last_hit_at.desc()) \
+        .offset(GENERATION_CACHE_MAX_ENTRIES) \
+        .all()
+    if overflow:
+        session.query(GenerationCacheRecord) \
+            .filter(GenerationCacheRecord.key.in_([key for key, in overflow])) \
+            .delete(synchronize_session=False)
+
+
+def cache_stats():
+    session = SessionLocal()
+    entries = session.query(GenerationCacheRecord).count()
+    session.close()
+
+    with stats_lock:
+        hits, misses = stats["hits"], stats["misses"]
+    return {
+        "enabled": ENABLE_GENERATION_CACHE,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / (hits + misses), 4) if hits + misses else None,
+        "entries": entries,
+        "max_entries": GENERATION_CACHE_MAX_ENTRIES,
+    }
@@ -0,0 +1,155 @@
+import datetime
+import json
+import random
+import threading
+from time import sleep
+
+import requests
+from dotenv import dotenv_values
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from models import SessionLocal, DeliveryRecord
+
+config = dotenv_values(".env")
+
+HTTP_CONNECT_TIMEOUT = float(config.get('HTTP_CONNECT_TIMEOUT', 3))
+HTTP_READ_TIMEOUT = float(config.get('HTTP_READ_TIMEOUT', 10))
+HTTP_RETRIES = int(config.get('HTTP_RETRIES', 3))
+HTTP_RETRY_BACKOFF_SECONDS = float(config.get('HTTP_RETRY_BACKOFF_SECONDS', 0.5))
+HTTP_POOL_SIZE = int(config.get('HTTP_POOL_SIZE', 10))
+OUTBOX_POLL_SECONDS = float(config.get('OUTBOX_POLL_SECONDS', 10))
+OUTBOX_MAX_ATTEMPTS = int(config.get('OUTBOX_MAX_ATTEMPTS', 10))
+OUTBOX_RETRY_BACKOFF_SECONDS = float(config.get('OUTBOX_RETRY_BACKOFF_SECONDS', 30))
+# a claimed delivery's next_attempt_at is its lease: still `sending` after this long, its process died
+OUTBOX_SENDING_TIMEOUT_SECONDS = float(config.get('OUTBOX_SENDING_TIMEOUT_SECONDS', 300))
+TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+
+def build_session():
+    # POSTs are only retried when the connection failed, i.e. the peer never saw the request;
+    # idempotent methods are also retried on read errors and 502/503/504
+    retry = Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_RETRY_BACKOFF_SECONDS,
+        backoff_jitter=HTTP_RETRY_BACKOFF_SECONDS,
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    s = requests.Session()
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
+
+
+# one keep-alive connection pool per process, shared by every inter-service call
+session = build_session()
+
+
+def get(url, **kwargs):
+    kwargs.setdefault("timeout", TIMEOUT)
+    return session.get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    kwargs.setdefault("timeout", TIMEOUT)
+    return session.post(url, **kwargs)
+
+
+def post_with_outbox(url, payload):
+    """POST json `payload`; if the peer is unreachable or failing, keep it in the outbox for later.
+
+    Returns "sent", "deferred" or "rejected" (4xx, retrying would not help).
+    """
+    try:
+        res = post(url, json=payload)
+    except requests.RequestException as e:
+        print(f"Deferring POST {url}: EXP/{e}")
+        defer(url, payload, str(e))
+        return "deferred"
+
+    if res.status_code < 300:
+        return "sent"
+    if res.status_code < 500:
+        print(f"POST {url} rejected: RES/{res.status_code}")
+        return "rejected"
+
+    print(f"Deferring POST {url}: RES/{res.status_code}")
+    defer(url, payload, f"RES/{res.status_code}")
+    return "deferred"
+
+
+def defer(url, payload, error=None):
+    db = SessionLocal()
+    db.add(DeliveryRecord(url=url, payload=json.dumps(payload), attempts=1, last_error=error,
+                          next_attempt_at=next_attempt(1)))
+    db.commit()
+    db.close()
+
+
+def next_attempt(attempts):
+    delay = OUTBOX_RETRY_BACKOFF_SECONDS * 2 ** (attempts - 1)
+    return datetime.datetime.now() + datetime.timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+def deliver_due():
+    # due deliveries, and deliveries whose process stopped before finishing them
+    now = datetime.datetime.now()
+    due = (DeliveryRecord.status.in_(("queued", "sending")), DeliveryRecord.next_attempt_at <= now)
+    lease = now + datetime.timedelta(seconds=OUTBOX_SENDING_TIMEOUT_SECONDS)
+
+    db = SessionLocal()
+    candidates = db.query(DeliveryRecord.id) \
+        .filter(*due) \
+        .order_by(DeliveryRecord.id) \
+        .limit(50) \
+        .all()
+    for delivery_id, in candidates:
+        # compare-and-set, the app and the llm service both drain the same outbox
+        if not db.query(DeliveryRecord).filter(DeliveryRecord.id == delivery_id, *due) \
+                .update({"status": "sending", "next_attempt_at": lease}, synchronize_session=False):
+            continue
+        db.commit()
+
+        record = db.get(DeliveryRecord, delivery_id)
+        status_code = None
+        try:
+            status_code = post(record.url, json=json.loads(record.payload)).status_code
+            error = None if status_code < 300 else f"RES/{status_code}"
+        except Exception as e:
+            # not only unreachable peers, whatever failed counts as an attempt rather than staying `sending`
+            error = str(e)
+
+        record.attempts += 1
+        if error is None:
+            record.status = "sent"
+            record.sent_at = datetime.datetime.now()
+        elif status_code is not None and status_code < 500 or record.attempts >= OUTBOX_MAX_ATTEMPTS:
+            print(f"Giving up on POST {record.url}: {error}")
+            record.status, record.last_error = "failed", error
+        else:
+            record.status, record.last_error = "queued", error
+            record.next_attempt_at = next_attempt(record.attempts)
+        db.commit()
+    db.close()
+
+
+def outbox_worker():
+    while True:
+        sleep(OUTBOX_POLL_SECONDS)
+        try:
+            deliver_due()
+        except Exception as e:
+            print(f"Failed to drain outbox: EXP/{e}")
+
+
+worker = None
+
+
+def start_outbox_worker():
+    global worker
+    if worker is None:
+        worker = threading.Thread(target=outbox_worker, name="http-outbox", daemon=True)
+        worker.start()
+    return worker
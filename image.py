@@ -1,47 +1,129 @@
+from functools import lru_cache
+
 from PIL import Image, ImageDraw, ImageFont
 
+PADDING_X, PADDING_Y = 16, 16
+RIGHT_TEXT = "Inecosys GmbH"
+FONT_PATH = "./fend/jetbrains.ttf"
+FONT_SIZE = 36
+TARGET_RATIO = 16 / 9
+
+# largest first, every smaller rendition is resized from the finished first one
+RENDITIONS = (
+    ("linkedin", (1200, 675)),
+    ("thumb", (400, 225)),
+)
+JPEG_OPTIONS = {"quality": 85, "optimize": True, "progressive": True}
+WEBP_OPTIONS = {"quality": 80, "method": 4}
+
+
+@lru_cache(maxsize=16)
+def load_font(font_path, font_size):
+    return ImageFont.truetype(font_path, font_size)
+
+
+def text_width(text, font):
+    left, _, right, _ = font.getbbox(text)
+    return right - left
+
+
+@lru_cache(maxsize=32)
+def render_band(width, right_text, font_path, font_size):
+    # white band with the company name on the right; identical for every image of the same width
+    font = load_font(font_path, font_size)
+    band = Image.new("RGB", (width, font_size + 2 * PADDING_Y), "white")
+    draw = ImageDraw.Draw(band)
+    draw.text((width - text_width(right_text, font) - PADDING_X, PADDING_Y), right_text, font=font, fill="black")
+    return band
+
+
+@lru_cache(maxsize=64)
+def render_banner(width, center_text, right_text, font_path, font_size):
+    # a batch shares its caption, so the finished banner is cached as well
+    font = load_font(font_path, font_size)
+    banner = render_band(width, right_text, font_path, font_size).copy()
+    draw = ImageDraw.Draw(banner)
+    draw.text(((width - text_width(center_text, font)) // 2, PADDING_Y), center_text, font=font, fill="black")
+    return banner
+
+
+def crop_box(w, h):
+    # Target 16:9 crop centered
+    new_w = w
+    new_h = int(w / TARGET_RATIO)
+    if new_h > h:
+        new_h = h
+        new_w = int(h * TARGET_RATIO)
+
+    left = (w - new_w) // 2
+    top = (h - new_h) // 2
+    return left, top, left + new_w, top + new_h
+
+
 def prepare_linkedin_image(
         image_path,
         output_path,
         center_text,
-        right_text="Inecosys GmbH",
-        font_path="./fend/jetbrains.ttf",
-        font_size=36
+        right_text=RIGHT_TEXT,
+        font_path=FONT_PATH,
+        font_size=FONT_SIZE
 ):
     img = Image.open(image_path).convert("RGB")
     w, h = img.size
 
-    # Target 16:9 crop centered (from chatgpt)
-    target_ratio = 16 / 9
-    new_w = w
-    new_h = int(w / target_ratio)
-    if new_h > h:
-        new_h = h
-        new_w = int(h * target_ratio)
+    img_cropped = img.crop(crop_box(w, h))
 
-    left = (w - new_w) // 2
-    top = (h - new_h) // 2
-    img_cropped = img.crop((left, top, left + new_w, top + new_h))
-
-    draw = ImageDraw.Draw(img_cropped)
-    font = ImageFont.truetype(font_path, font_size)
-    padding_x, padding_y = 16, 16
-    text_area_height = font_size + 2 * padding_y
     img_w, img_h = img_cropped.size
-    rect_y0 = img_h - text_area_height
-    rect_y1 = img_h
-    draw.rectangle([(0, rect_y0), (img_w, rect_y1)], fill="white")
-
-    center_text_size = draw.textbbox((0, 0), center_text, font=font)
-    center_text_width = center_text_size[2] - center_text_size[0]
-    center_text_x = (img_w - center_text_width) // 2
-    center_text_y = rect_y0 + padding_y
-    draw.text((center_text_x, center_text_y), center_text, font=font, fill="black")
-
-    right_text_size = draw.textbbox((0, 0), right_text, font=font)
-    right_text_width = right_text_size[2] - right_text_size[0]
-    right_text_x = img_w - right_text_width - padding_x
-    right_text_y = rect_y0 + padding_y
-    draw.text((right_text_x, right_text_y), right_text, font=font, fill="black")
+    banner = render_banner(img_w, center_text, right_text, font_path, font_size)
+    img_cropped.paste(banner, (0, img_h - banner.height))
 
     img_cropped.save(output_path)
+
+
+def prepare_linkedin_renditions(
+        image_path,
+        output_base,
+        center_text,
+        right_text=RIGHT_TEXT,
+        font_path=FONT_PATH,
+        font_size=FONT_SIZE,
+        renditions=RENDITIONS,
+        webp=False,
+        jpeg_options=None,
+        webp_options=None,
+):
+    """Write every rendition as `<output_base>-<name>.jpg` (and `.webp`) and return {name: [paths]}.
+
+    Unlike prepare_linkedin_image the source is only decoded at the resolution the largest
+    rendition needs: JPEGs are DCT-scaled while decoding (draft mode), other formats are
+    reduced while resizing.
+    """
+    jpeg_options = {**JPEG_OPTIONS, **(jpeg_options or {})}
+    webp_options = {**WEBP_OPTIONS, **(webp_options or {})}
+    _, (target_w, target_h) = renditions[0]
+
+    img = Image.open(image_path)
+    w, h = img.size
+    box = crop_box(w, h)
+    scale = max(target_w / (box[2] - box[0]), target_h / (box[3] - box[1]))
+    if scale < 1 and img.format == "JPEG":
+        # decodes at 1/2, 1/4 or 1/8 scale, never below the requested size
+        img.draft("RGB", (int(w * scale) + 1, int(h * scale) + 1))
+        ratio_x, ratio_y = img.size[0] / w, img.size[1] / h
+        box = (box[0] * ratio_x, box[1] * ratio_y, box[2] * ratio_x, box[3] * ratio_y)
+    img = img.convert("RGB")
+
+    # crops and resizes in one pass, reducing_gap lets Pillow shrink by whole factors first
+    rendered = img.resize((target_w, target_h), Image.LANCZOS, box=box, reducing_gap=3.0)
+    banner = render_banner(target_w, center_text, right_text, font_path, font_size)
+    rendered.paste(banner, (0, target_h - banner.height))
+
+    outputs = {}
+    for name, size in renditions:
+        image = rendered if size == (target_w, target_h) else rendered.resize(size, Image.LANCZOS, reducing_gap=2.0)
+        outputs[name] = [f"{output_base}-{name}.jpg"]
+        image.save(outputs[name][0], "JPEG", **jpeg_options)
+        if webp:
+            outputs[name].append(f"{output_base}-{name}.webp")
+            image.save(outputs[name][1], "WEBP", **webp_options)
+    return outputs
@@ -0,0 +1,281 @@
+"""Prepare many images at once on a process pool.
+
+    python image_batch.py photos/ more.jpg export.zip --caption "Bauma 2025 Muenchen" -o prepared.zip
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import perf_counter, sleep, time
+
+from dotenv import dotenv_values
+
+from image import prepare_linkedin_image, prepare_linkedin_renditions
+
+config = dotenv_values(".env")
+
+IMAGE_WORKERS = int(config.get('IMAGE_WORKERS') or os.cpu_count() or 1)
+# write the LinkedIn and thumbnail renditions (image.RENDITIONS) instead of one full-size copy
+ENABLE_IMAGE_RENDITIONS = config.get('ENABLE_IMAGE_RENDITIONS', 'False') == 'True'
+IMAGE_WEBP = config.get('IMAGE_WEBP', 'False') == 'True'
+IMAGE_JPEG_QUALITY = int(config.get('IMAGE_JPEG_QUALITY', 85))
+IMAGE_WEBP_QUALITY = int(config.get('IMAGE_WEBP_QUALITY', 80))
+IMAGE_EXTENSIONS = tuple(f".{ext}" for ext in (config.get('ALLOWED_EXTENSIONS') or 'jpg,jpeg,png').split(','))
+# finished batches (status and files) are kept this long for the download, then removed
+IMAGE_BATCH_TTL_SECONDS = float(config.get('IMAGE_BATCH_TTL_SECONDS', 24 * 3600))
+IMAGE_BATCH_PURGE_SECONDS = float(config.get('IMAGE_BATCH_PURGE_SECONDS', 600))
+
+pool = None
+pool_lock = threading.Lock()
+batches = {}
+purger = None
+
+
+def get_pool():
+    global pool
+    with pool_lock:
+        if pool is None:
+            # spawn, the web process runs threads and must not be forked mid-request
+            pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return pool
+
+
+def prepare_renditions(image_path, output_base, caption):
+    outputs = prepare_linkedin_renditions(image_path, output_base, caption, webp=IMAGE_WEBP,
+                                          jpeg_options={"quality": IMAGE_JPEG_QUALITY},
+                                          webp_options={"quality": IMAGE_WEBP_QUALITY})
+    return [path for paths in outputs.values() for path in paths]
+
+
+def prepare_one(image_path, output_path, caption):
+    # runs in a pool process, so the duration is measured here and handed back with the paths
+    started = perf_counter()
+    if ENABLE_IMAGE_RENDITIONS:
+        output_paths = prepare_renditions(image_path, os.path.splitext(output_path)[0], caption)
+    else:
+        prepare_linkedin_image(image_path, output_path, caption)
+        output_paths = [output_path]
+    return output_paths, perf_counter() - started
+
+
+def output_name(filename):
+    name, ext = os.path.splitext(os.path.basename(filename))
+    return f"{name}-prep{ext}"
+
+
+def read_captions(data):
+    try:
+        captions = json.loads(data)
+    except ValueError as e:
+        raise ValueError(f"captions.json is not valid JSON: {e}")
+    if not isinstance(captions, dict) or not all(isinstance(value, str) for value in captions.values()):
+        raise ValueError("captions.json must be an object of {filename: caption}")
+    return captions
+
+
+def extract_zip(zip_path, target_dir):
+    """Extract the images of an archive, plus an optional captions.json ({filename: caption}).
+
+    Raises ValueError for an archive that cannot be read or a malformed captions.json.
+    """
+    images, captions = [], {}
+    try:
+        archive = zipfile.ZipFile(zip_path)
+    except zipfile.BadZipFile as e:
+        raise ValueError(f"{os.path.basename(zip_path)} is not a zip archive: {e}")
+    # a directory of its own, several archives of the same name may be extracted into `target_dir`
+    root = tempfile.mkdtemp(prefix=f"{os.path.basename(zip_path)}-", dir=target_dir)
+    with archive:
+        for info in archive.infolist():
+            name = os.path.basename(info.filename)
+            if info.is_dir() or not name or name.startswith('.'):
+                continue
+            if name == "captions.json":
+                captions = read_captions(archive.read(info))
+                continue
+            if not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            path = os.path.join(root, str(len(images)), name)
+            os.makedirs(os.path.dirname(path))
+            with archive.open(info) as src, open(path, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            images.append((path, name))
+    return [(path, captions.get(name)) for path, name in images]
+
+
+def run_batch(items, caption, output_dir, zip_path, executor, progress=None):
+    """Prepare (image_path, caption or None) items on `executor` and zip the results.
+
+    `progress(seconds)` is called after every image, with its preparation time or None if it failed.
+    Returns a list of (image_path, error) for the images that could not be prepared.
+    """
+    futures = {}
+    used_names = set()
+    for image_path, item_caption in items:
+        name = output_name(image_path)
+        # two uploads called IMG_0001.jpg must not overwrite each other in the zip
+        while name in used_names:
+            stem, ext = os.path.splitext(name)
+            name = f"{stem}-{len(used_names)}{ext}"
+        used_names.add(name)
+        future = executor.submit(prepare_one, image_path, os.path.join(output_dir, name), item_caption or caption)
+        futures[future] = image_path
+
+    errors = []
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_STORED) as archive:
+        for future in as_completed(futures):
+            seconds = None
+            try:
+                output_paths, seconds = future.result()
+            except Exception as e:
+                errors.append((futures[future], str(e)))
+            else:
+                # jpeg/png are already compressed, storing them is faster and not larger
+                for output_path in output_paths:
+                    archive.write(output_path, os.path.basename(output_path))
+            if progress:
+                progress(seconds)
+    return errors
+
+
+class Batch:
+    def __init__(self, batch_id, batch_dir, total):
+        self.id = batch_id
+        self.dir = batch_dir
+        self.zip_path = os.path.join(batch_dir, "prepared.zip")
+        self.total = total
+        self.done = 0
+        self.errors = []
+        self.status = "running"  # running / done / failed
+        self.finished_at = None
+
+    def dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "total": self.total,
+            "done": self.done,
+            "errors": [{"file": os.path.basename(path), "error": error} for path, error in self.errors],
+        }
+
+
+def new_batch_dir(upload_folder):
+    batch_id = uuid.uuid4().hex
+    batch_dir = os.path.join(upload_folder, "batches", batch_id)
+    os.makedirs(os.path.join(batch_dir, "in"))
+    os.makedirs(os.path.join(batch_dir, "out"))
+    return batch_id, batch_dir
+
+
+def submit_batch(batch_id, batch_dir, items, caption):
+    """Run a batch in the background; the web process only waits on the pool from a helper thread."""
+    # imported here, pool processes import this module and must not pull in flask and the database
+    from metrics import image_prep
+
+    batch = batches[batch_id] = Batch(batch_id, batch_dir, len(items))
+
+    def progress(seconds):
+        batch.done += 1
+        if seconds is not None:
+            image_prep.observe(seconds, mode="batch")
+
+    def run():
+        try:
+            batch.errors = run_batch(items, caption, os.path.join(batch_dir, "out"), batch.zip_path, get_pool(),
+                                     progress)
+            # some failed images are listed in `errors`, a batch without any prepared image failed
+            batch.status = "failed" if len(batch.errors) == len(items) else "done"
+        except Exception as e:
+            print(f"Failed to prepare batch {batch_id}: EXP/{e}")
+            batch.status = "failed"
+        batch.finished_at = time()
+
+    threading.Thread(target=run, name=f"image-batch-{batch_id}", daemon=True).start()
+    return batch
+
+
+def purge_batches(upload_folder, ttl=IMAGE_BATCH_TTL_SECONDS):
+    """Remove batches finished more than `ttl` seconds ago, and batch directories a previous run
+    left behind once nothing in them changed for as long."""
+    oldest = time() - ttl
+    for batch_id, batch in list(batches.items()):
+        if batch.finished_at is not None and batch.finished_at < oldest:
+            del batches[batch_id]
+            shutil.rmtree(batch.dir, ignore_errors=True)
+
+    root = os.path.join(upload_folder, "batches")
+    if not os.path.isdir(root):
+        return
+    for batch_id in os.listdir(root):
+        batch_dir = os.path.join(root, batch_id)
+        if batch_id in batches:
+            continue
+        try:
+            changed = max([os.path.getmtime(batch_dir)] + [os.path.getmtime(os.path.join(path, name))
+                                                            for path, _, files in os.walk(batch_dir) for name in files])
+        except OSError:
+            continue
+        if changed < oldest:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+
+
+def purge_loop(upload_folder):
+    while True:
+        try:
+            purge_batches(upload_folder)
+        except Exception as e:
+            print(f"Failed to purge image batches: EXP/{e}")
+        sleep(IMAGE_BATCH_PURGE_SECONDS)
+
+
+def start_batch_purger(upload_folder):
+    global purger
+    if purger is None:
+        purger = threading.Thread(target=purge_loop, args=(upload_folder,), name="image-batch-purge", daemon=True)
+        purger.start()
+    return purger
+
+
+def collect_inputs(paths, work_dir):
+    items = []
+    for path in paths:
+        if os.path.isdir(path):
+            items += [(os.path.join(path, name), None) for name in sorted(os.listdir(path))
+                      if name.lower().endswith(IMAGE_EXTENSIONS)]
+        elif path.lower().endswith(".zip"):
+            items += extract_zip(path, work_dir)
+        else:
+            items.append((path, None))
+    return items
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="+", help="images, directories of images or zip archives")
+    parser.add_argument("--caption", required=True, help="caption for images without an entry in captions.json")
+    parser.add_argument("-o", "--output", default="prepared.zip")
+    parser.add_argument("--workers", type=int, default=IMAGE_WORKERS)
+    args = parser.parse_args()
+
+    work_dir = os.path.abspath(os.path.splitext(args.output)[0] + "-work")
+    os.makedirs(os.path.join(work_dir, "out"), exist_ok=True)
+    try:
+        items = collect_inputs(args.inputs, work_dir)
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            errors = run_batch(items, args.caption, os.path.join(work_dir, "out"), args.output, executor)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"Prepared {len(items) - len(errors)}/{len(items)} images into {args.output}")
+    for path, error in errors:
+        print(f"  {path}: {error}")
+
+
+if __name__ == "__main__":
+    main()
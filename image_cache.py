@@ -0,0 +1,146 @@
+"""Uploads stored by content hash and an LRU disk cache of prepared images.
+
+An upload is hashed while it is streamed to disk and kept as `<sha256>.<ext>`, so a photo uploaded
+twice is stored once and two photos both called IMG_0001.jpg no longer overwrite each other.
+Prepared images are named `prep-<key>...` after the hash of the image, the caption and everything
+else that changes the output; a request whose output already exists is answered without
+touching the image. Uploads and prepared images are evicted least recently used first once
+the upload folder holds more than IMAGE_CACHE_MAX_BYTES of them.
+"""
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+
+from dotenv import dotenv_values
+
+from image import RIGHT_TEXT, FONT_PATH, FONT_SIZE, RENDITIONS
+from image_batch import IMAGE_WEBP, IMAGE_JPEG_QUALITY, IMAGE_WEBP_QUALITY
+
+config = dotenv_values(".env")
+
+IMAGE_CACHE_MAX_BYTES = int(config.get('IMAGE_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+CHUNK_SIZE = 64 * 1024
+
+# one entry per upload (`<sha256>`) or prepared image with its renditions (`prep-<key>`);
+# other files in the upload folder, like earlier uploads and batch directories, are left alone
+ENTRY = re.compile(r"^(prep-[0-9a-f]{32}|[0-9a-f]{64})(?=[.-])")
+
+
+class DiskLRU:
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.entries = None  # entry -> (size in bytes, file names), least recently used first
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        # what earlier runs left behind, the oldest files count as least recently used
+        if self.entries is not None:
+            return
+        found = {}
+        for name in os.listdir(self.folder):
+            match = ENTRY.match(name)
+            if match:
+                stat = os.stat(os.path.join(self.folder, name))
+                size, names, mtime = found.get(match.group(1), (0, [], 0))
+                found[match.group(1)] = (size + stat.st_size, names + [name], max(mtime, stat.st_mtime))
+        self.entries = OrderedDict((entry, (size, names))
+                                   for entry, (size, names, _) in sorted(found.items(), key=lambda i: i[1][2]))
+        self.total = sum(size for size, _ in self.entries.values())
+
+    def put(self, entry, names):
+        self.total -= self.entries.pop(entry, (0, []))[0]
+        size = sum(os.path.getsize(os.path.join(self.folder, name)) for name in names)
+        self.entries[entry] = (size, names)
+        self.total += size
+
+    def hit(self, entry, name):
+        """True if `name` of `entry` is on disk; marks the entry as used."""
+        with self.lock:
+            self.load()
+            if not os.path.exists(os.path.join(self.folder, name)):
+                return False
+            if entry in self.entries:
+                self.entries.move_to_end(entry)
+            else:
+                # written by another app process
+                self.put(entry, [name])
+            return True
+
+    def add(self, entry, names):
+        """Account for the files just written for `entry` and evict others over the budget."""
+        with self.lock:
+            self.load()
+            self.put(entry, names)
+            while self.total > self.max_bytes and len(self.entries) > 1:
+                _, (size, oldest_names) = self.entries.popitem(last=False)
+                self.total -= size
+                for name in oldest_names:
+                    try:
+                        os.remove(os.path.join(self.folder, name))
+                    except OSError as e:
+                        print(f"Failed to evict {name}: EXP/{e}")
+
+
+caches = {}
+caches_lock = threading.Lock()
+
+
+def get_cache(folder):
+    with caches_lock:
+        if folder not in caches:
+            caches[folder] = DiskLRU(folder, IMAGE_CACHE_MAX_BYTES)
+        return caches[folder]
+
+
+def save_upload(file, folder, ext):
+    """Stream an uploaded FileStorage to `<sha256>.<ext>`; returns (digest, path)."""
+    digest = hashlib.sha256()
+    fd, part_path = tempfile.mkstemp(dir=folder, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in iter(lambda: file.stream.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+                out.write(chunk)
+        path = os.path.join(folder, f"{digest.hexdigest()}.{ext}")
+        if os.path.exists(path):
+            os.remove(part_path)
+        else:
+            os.replace(part_path, path)
+    except Exception:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+    get_cache(folder).add(digest.hexdigest(), [os.path.basename(path)])
+    return digest.hexdigest(), path
+
+
+def prepared_base(digest, caption, renditions=False):
+    """`prep-<key>` for the prepared image of an upload with this caption and the current settings."""
+    key = {"image": digest, "caption": caption, "right_text": RIGHT_TEXT, "font": FONT_PATH, "font_size": FONT_SIZE}
+    if renditions:
+        key.update(sizes=RENDITIONS, webp=IMAGE_WEBP, jpeg_quality=IMAGE_JPEG_QUALITY, webp_quality=IMAGE_WEBP_QUALITY)
+    return "prep-" + hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:32]
+
+
+def write_prepared(folder, base, write):
+    """Run `write(output_base)`, which returns the paths it wrote, on a temporary base name and move
+    the files to `base` afterwards, so a concurrent request never finds a half written image."""
+    part = f"{base}.{os.urandom(4).hex()}"
+    names = []
+    try:
+        for path in write(os.path.join(folder, part)):
+            names.append(base + os.path.basename(path)[len(part):])
+            os.replace(path, os.path.join(folder, names[-1]))
+    except Exception:
+        for name in os.listdir(folder):
+            if name.startswith(part):
+                os.remove(os.path.join(folder, name))
+        raise
+    get_cache(folder).add(base, names)
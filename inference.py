@@ -0,0 +1,183 @@
+import copy
+import threading
+from time import perf_counter
+
+# torch and transformers are imported inside the functions below; importing them takes seconds,
+# which the llm service should only pay once generation is actually needed.
+
+# INFERENCE_MODE is a comma separated list of these options, e.g. "bf16,compile"; empty means plain fp32
+INFERENCE_OPTIONS = ("bf16", "int8", "compile")
+
+
+def parse_inference_mode(mode):
+    options = {option.strip() for option in (mode or "").split(",") if option.strip() and option.strip() != "fp32"}
+    unknown = options - set(INFERENCE_OPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown inference mode option(s): {', '.join(sorted(unknown))}")
+    if {"bf16", "int8"} <= options:
+        raise ValueError("bf16 and int8 cannot be combined; dynamic quantization needs fp32 linear layers")
+    return options
+
+
+def load_model(model_name, device, mode=""):
+    """Load MODEL_NAME for inference in the given INFERENCE_MODE.
+
+    bf16    load the weights in bfloat16 (half the RAM, faster matmuls on CPUs with AVX512-BF16/AMX)
+    int8    dynamic int8 quantization of all linear layers (CPU only)
+    compile wrap the forward pass with torch.compile
+    """
+    import torch
+    from transformers import AutoModelForCausalLM
+
+    options = parse_inference_mode(mode)
+    if "int8" in options and device != "cpu":
+        raise ValueError("int8 dynamic quantization is only supported on cpu")
+
+    dtype = torch.bfloat16 if "bf16" in options else torch.float32
+    model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=dtype, low_cpu_mem_usage=True)
+    model.to(device)
+    model.eval()
+
+    if "int8" in options:
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if "compile" in options:
+        # dynamic shapes, prompt and batch sizes change on every call
+        model.forward = torch.compile(model.forward, dynamic=True)
+
+    print(f"Loaded {model_name} on {device} ({', '.join(sorted(options)) or 'fp32'})")
+    return model
+
+
+class ForwardCounter:
+    """Counts forward passes of a model, per thread, so concurrent generations do not mix their counts."""
+
+    def __init__(self, model):
+        self.local = threading.local()
+        model.register_forward_hook(self.hook)
+
+    def hook(self, module, args, output):
+        self.local.count = self.count + 1
+
+    @property
+    def count(self):
+        return getattr(self.local, "count", 0)
+
+
+def same_vocabulary(tokenizer, model_config, draft_tokenizer, draft_config):
+    # assisted generation compares token ids directly, they have to mean the same text in both models
+    return (model_config.get_text_config().vocab_size == draft_config.get_text_config().vocab_size
+            and tokenizer.get_vocab() == draft_tokenizer.get_vocab())
+
+
+class Engine:
+    """Tokenizer and model for generation, plus the prefilled past-key-values of the prompt prefix
+    and an optional draft model for assisted generation."""
+
+    def __init__(self, model_name, device, mode="", prompt_prefix=None, draft_model_name=None, draft_tokens=None):
+        import torch
+        from transformers import AutoTokenizer
+
+        self.model_name = model_name
+        self.device = device
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        # decoder-only models need left padding so every prompt ends right before the new tokens
+        self.tokenizer.padding_side = 'left'
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = load_model(model_name, device, mode)
+
+        self.prompt_prefix, self.prefix_ids, self.prefix_cache = prompt_prefix, None, None
+        if prompt_prefix:
+            self.prefix_ids = self.tokenizer(prompt_prefix, return_tensors="pt").input_ids.to(device)
+            with torch.inference_mode():
+                self.prefix_cache = self.model(self.prefix_ids, use_cache=True).past_key_values
+            print(f"Prefilled prompt prefix: {self.prefix_ids.shape[1]} tokens")
+
+        self.draft_model = None
+        if draft_model_name:
+            self.load_draft_model(draft_model_name, mode, draft_tokens)
+
+    def load_draft_model(self, draft_model_name, mode, draft_tokens):
+        from transformers import AutoConfig, AutoTokenizer
+
+        # checked before the weights are loaded
+        draft_tokenizer = AutoTokenizer.from_pretrained(draft_model_name)
+        if not same_vocabulary(self.tokenizer, self.model.config, draft_tokenizer,
+                               AutoConfig.from_pretrained(draft_model_name)):
+            print(f"Draft model {draft_model_name} does not share the vocabulary of {self.model_name}, "
+                  f"generating without it")
+            return
+
+        draft_model = load_model(draft_model_name, self.device, mode)
+
+        if draft_tokens:
+            # starting number of draft tokens per step, HF adapts it to the acceptance rate as it goes
+            draft_model.generation_config.num_assistant_tokens = draft_tokens
+        self.draft_model = draft_model
+        self.model_calls = ForwardCounter(self.model)
+        self.draft_calls = ForwardCounter(self.draft_model)
+
+    def encode(self, prompts):
+        """Build the model.generate inputs for a batch of prompts.
+
+        With the prefix cache only the event-specific suffixes are tokenized; they are left-padded and
+        placed after the shared prefix, so the cached past-key-values line up for every row.
+        """
+        import torch
+
+        if self.prefix_cache is None:
+            return dict(self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.device))
+
+        batch = len(prompts)
+        suffixes = [prompt[len(self.prompt_prefix):] for prompt in prompts]
+        encoded = self.tokenizer(suffixes, return_tensors="pt", padding=True, add_special_tokens=False).to(self.device)
+        cache = copy.deepcopy(self.prefix_cache)
+        cache.batch_repeat_interleave(batch)
+        return {
+            "input_ids": torch.cat([self.prefix_ids.expand(batch, -1), encoded.input_ids], dim=1),
+            "attention_mask": torch.cat(
+                [torch.ones_like(self.prefix_ids).expand(batch, -1), encoded.attention_mask], dim=1),
+            "past_key_values": cache,
+        }
+
+
+class LazyEngine:
+    """Builds the Engine on first use (or in a warm-up thread) and reports readiness meanwhile."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.engine = None
+        self.status = "cold"  # cold / loading / ready / failed
+        self.error = None
+        self.load_seconds = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        if self.engine is not None:
+            return self.engine
+
+        with self.lock:
+            if self.engine is None:
+                self.status = "loading"
+                started = perf_counter()
+                try:
+                    self.engine = self.factory()
+                except Exception as e:
+                    self.status, self.error = "failed", str(e)
+                    raise
+                self.load_seconds = perf_counter() - started
+                self.status, self.error = "ready", None
+        return self.engine
+
+    def warm_up(self):
+        def load():
+            try:
+                self.get()
+            except Exception as e:
+                print(f"Failed to warm up model: EXP/{e}")
+
+        threading.Thread(target=load, name="model-warm-up", daemon=True).start()
+
+    @property
+    def ready(self):
+        return self.engine is not None
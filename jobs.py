@@ -0,0 +1,91 @@
+import datetime
+
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.schedulers.background import BackgroundScheduler
+from dotenv import dotenv_values
+from sqlalchemy import or_
+
+import claims
+from models import engine, SessionLocal, PostRecord
+
+config = dotenv_values(".env")
+
+JOB_MAX_RETRIES = int(config.get('JOB_MAX_RETRIES', 3))
+JOB_RETRY_BACKOFF_SECONDS = float(config.get('JOB_RETRY_BACKOFF_SECONDS', 30))
+
+# jobs survive restarts in the `generation_jobs` table next to the posts, which every llm service
+# on the same database shares. APScheduler does not coordinate schedulers sharing a job store, any of
+# them may run a job and two may run the same one; run_task() leases the task first, so only one of
+# them generates it. Use claim workers (claims.py) to spread generation over several services.
+# the scheduler is only created by start() so importing this module has no side effects.
+scheduler = None
+handlers = {}
+
+
+def start(handler, on_give_up, workers):
+    """Start the durable scheduler; `handler(task_id, data)` runs one job, `on_give_up(task_id)` ends retries."""
+    global scheduler
+    handlers['run'] = handler
+    handlers['give_up'] = on_give_up
+
+    scheduler = BackgroundScheduler(
+        jobstores={'default': SQLAlchemyJobStore(engine=engine, tablename='generation_jobs')},
+        executors={'default': ThreadPoolExecutor(max_workers=workers)},
+        job_defaults={'coalesce': True, 'max_instances': 1, 'misfire_grace_time': None},
+    )
+    scheduler.start()
+    recover()
+    # rows of a process that died hold a lease for a while, so recovery is repeated as leases run out
+    scheduler.add_job('jobs:recover', trigger='interval', seconds=claims.CLAIM_LEASE_SECONDS, id='recover',
+                      replace_existing=True)
+    claims.start_heartbeat()
+    return scheduler
+
+
+def enqueue(task_id, data, attempt=0, delay=0):
+    run_date = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+    # referenced by name so the job store can resolve it again after a restart
+    scheduler.add_job('jobs:run_task', trigger='date', run_date=run_date, args=[task_id, data, attempt],
+                      id=f"task-{task_id}", replace_existing=True)
+
+
+def run_task(task_id, data, attempt):
+    # the job may have been queued by another service or an earlier run, so this worker has to hold
+    # the lease before generating, otherwise save_post_to_database() is rejected
+    if not claims.acquire(task_id):
+        print(f"Task_id {task_id} is leased by another worker, skipping its job")
+        return
+    try:
+        handlers['run'](task_id, data)
+    except Exception as e:
+        if attempt >= JOB_MAX_RETRIES:
+            print(f"Giving up on task_id {task_id} after {attempt + 1} attempts: EXP/{e}")
+            handlers['give_up'](task_id)
+            return
+
+        delay = JOB_RETRY_BACKOFF_SECONDS * 2 ** attempt
+        print(f"Task_id {task_id} failed (attempt {attempt + 1}), retrying in {delay}s: EXP/{e}")
+        claims.unlease(task_id, datetime.datetime.now() + datetime.timedelta(seconds=delay))
+        enqueue(task_id, data, attempt + 1, delay)
+
+
+def recover():
+    """Requeue rows left in `processing` whose lease or reservation ran out, by a previous run or
+    another llm service that died. Rows whose job is still pending are reserved again for it, rows
+    whose workers died CLAIM_MAX_ATTEMPTS times are failed, rows live workers hold are left alone."""
+    pending = lambda task_id: scheduler.get_job(f"task-{task_id}") is not None
+    claims.give_up_exhausted(handlers['give_up'], pending)
+
+    now = datetime.datetime.now()
+    session = SessionLocal()
+    stale = session.query(PostRecord.id).filter(
+        PostRecord.status == "processing",
+        or_(PostRecord.lease_expires_at.is_(None), PostRecord.lease_expires_at <= now)).all()
+    session.close()
+    for task_id, in stale:
+        data = claims.reserve(task_id)
+        if data is None or pending(task_id):
+            continue
+        print(f"Recovering stale task_id: {task_id}")
+        enqueue(task_id, data)
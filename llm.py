@@ -1,48 +1,65 @@
 import datetime
-from time import sleep
+import threading
+from concurrent.futures import Future
+from queue import Queue, Empty
+from time import sleep, monotonic, perf_counter
 
 from dotenv import dotenv_values
-import requests
-from apscheduler.schedulers.background import BackgroundScheduler
-from flask import Flask, request, jsonify
-from transformers import AutoModelForCausalLM, AutoTokenizer
-import torch
-
+from flask import Flask, request, jsonify, Response
+from sqlalchemy import update
+
+import claims
+import generation_cache
+import http_client
+import jobs
+import metrics
+from inference import Engine, LazyEngine
 from image import prepare_linkedin_image
-from models import SessionLocal, PostRecord
+from models import SessionLocal, PostRecord, db_session, init_app
+from stopping import PostStoppingCriteria, clean_post
+from streaming import open_stream, get_stream, close_stream, BatchStreamer, CancelCriteria
 
 config = dotenv_values(".env")
 
 device = config['INFERENCE_DEVICE']
 model_name = config['MODEL_NAME']
 
-#bootstrap model
-if config['ENABLE_LLM_GENERATION']=='True':
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    model = AutoModelForCausalLM.from_pretrained(model_name)
-    model.to(device)
-else:
-    print('LLM Disabled')
-
-def notify_personal(task_id):
-    if config['ENABLE_EMAIL']=='False':
-        print("Email not enabled")
-        print(f"Notification for task_id: {task_id}")
-        return True
-
-    try:
-        res = requests.post(f"{config['APP_SERVICE']}/webhook/update-post-status", json={"task_id": task_id})
-        if res.status_code != 200:
-            print(f"Failed to update new post: RES/{res.status_code}")
-            return False
-    except Exception as e:
-        print(f"Failed to notify APP new post: EXP/{e}")
-        return False
-    return True
-
-
-def make_prompt(event_title, date, description, good, bad, goal, instructions):
-    return f"""
+# approved tasks are collected for up to BATCH_WINDOW_SECONDS (or BATCH_MAX_SIZE tasks)
+# and generated together in a single padded model.generate call
+BATCH_MAX_SIZE = int(config.get('BATCH_MAX_SIZE', 8))
+BATCH_WINDOW_SECONDS = float(config.get('BATCH_WINDOW_SECONDS', 2))
+# number of batches generated concurrently; one per inference device is usually the sweet spot
+GENERATION_WORKERS = int(config.get('GENERATION_WORKERS', 1))
+# push partial text of every generation to /stream/<task_id> while it is being decoded
+ENABLE_STREAMING = config.get('ENABLE_STREAMING', 'False') == 'True'
+# prefill the fixed instruction block of every prompt once and reuse its past-key-values
+ENABLE_PREFIX_CACHE = config.get('ENABLE_PREFIX_CACHE', 'True') == 'True'
+# precision/quantization/compile options for the model, see inference.load_model
+INFERENCE_MODE = config.get('INFERENCE_MODE', '')
+# simulated generation time while ENABLE_LLM_GENERATION is False
+LLM_DISABLED_DELAY_SECONDS = float(config.get('LLM_DISABLED_DELAY_SECONDS', 10))
+# load the model in a background thread at startup instead of on the first generation
+LLM_WARMUP = config.get('LLM_WARMUP', 'False') == 'True'
+# end each row once it holds a finished post (see stopping.py) instead of always running to max_new_tokens
+ENABLE_POST_STOPPING = config.get('ENABLE_POST_STOPPING', 'True') == 'True'
+# small model sharing MODEL_NAME's vocabulary that drafts tokens for assisted generation; empty disables it
+DRAFT_MODEL_NAME = config.get('DRAFT_MODEL_NAME', '')
+# draft tokens proposed per step to begin with, adjusted by transformers as the acceptance rate changes
+DRAFT_TOKENS = int(config.get('DRAFT_TOKENS', 5))
+# claim approved posts from the database (claims.py) instead of waiting for /process-new-task;
+# any number of llm services or worker.py processes can share one database this way.
+# replaces ENABLE_SCHEDULED_GENERATION, the job scheduler and its recovery are not started
+ENABLE_CLAIM_WORKERS = config.get('ENABLE_CLAIM_WORKERS', 'False') == 'True'
+
+# sampling parameters of every generation, also part of the generation cache key
+GENERATION_PARAMS = {
+    "max_new_tokens": 700,
+    "temperature": 0.5,
+    "top_p": 0.9,
+    "do_sample": True,
+}
+
+PROMPT_PREFIX = """
 Write a LinkedIn post about my company Inecosys participation in an event.  And you are a 
 social media manager in company called "Inecosys", do not mention anywhere in the post that you are the manager.
 the Post SHOULD NOT exceed 200 words. Parameter called "Instructions" are extra comments from
@@ -51,7 +68,27 @@ any placeholders. DO NOT include any other information that haven't been given e
 in "we" form or passive. Compare parameters "Today" & "Event Date" to determine whether the event has already
 conducted or not. Following are parameters you should consider:
 
-Today: {datetime.datetime.today()}
+"""
+
+#bootstrap model, deferred until the first generation (or the warm-up thread) needs it
+engine = LazyEngine(lambda: Engine(model_name, device, INFERENCE_MODE, PROMPT_PREFIX if ENABLE_PREFIX_CACHE else None,
+                                   DRAFT_MODEL_NAME or None, DRAFT_TOKENS))
+if config['ENABLE_LLM_GENERATION'] != 'True':
+    print('LLM Disabled')
+
+def notify_personal(task_id, status="done"):
+    # always sent, the app pushes it to status subscribers and decides itself whether to email
+    # an unreachable app is retried from the outbox
+    result = http_client.post_with_outbox(f"{config['APP_SERVICE']}/webhook/update-post-status",
+                                          {"task_id": task_id, "status": status})
+    if result == "rejected":
+        print(f"Failed to notify APP new post: {task_id}")
+        return False
+    return True
+
+
+def make_prompt(event_title, date, description, good, bad, goal, instructions):
+    return PROMPT_PREFIX + f"""Today: {datetime.datetime.today()}
 Title: {event_title}
 Event Date: {date}
 Description: {description}
@@ -65,59 +102,58 @@ Post:
 """
 
 def retrieve_task_data(task_id):
-    session = SessionLocal()
+    session = db_session()
     print(f"Retrieving task data for task_id: {task_id}")
-    record = session.query(PostRecord).filter_by(id=int(task_id)).first()
-    if (not record) or (record.status != "approved") and (record.status != "queued"):
+    # compare-and-set, of two services racing for the same task only one gets its data; the
+    # reservation tells recovery that a job is about to be queued, whoever runs it leases the task
+    until = datetime.datetime.now() + datetime.timedelta(seconds=claims.CLAIM_LEASE_SECONDS)
+    claimed = session.execute(update(PostRecord)
+                              .where(PostRecord.id == int(task_id), PostRecord.status.in_(("approved", "queued")))
+                              .values(status="processing", **claims.reservation(until))).rowcount
+    if not claimed:
         print('req to produce 404 post')
+        session.rollback()
         session.close()
         return {}
 
-    record.status = "processing"
+    data = session.get(PostRecord, int(task_id)).dict()
     session.commit()
+    session.close()
 
-    return record.dict()
+    return data
 
 def save_post_to_database(task_id, post):
-    session = SessionLocal()
-
-    record = session.query(PostRecord).filter_by(id=task_id).first()
-    if not record or record.status != "processing":
-        session.close()
-        return False
-
+    values = {"status": "done", "lease_expires_at": None}
     if config['ENABLE_LLM_GENERATION'] == 'True':
-        record.post = post
+        values["post"] = post
 
-    record.status = "done"
+    # a task whose lease expired belongs to the worker that claimed it again
+    session = SessionLocal()
+    saved = session.execute(update(PostRecord)
+                            .where(claims.owned(task_id), PostRecord.status == "processing")
+                            .values(**values)).rowcount
     session.commit()
+    session.close()
+    claims.drop(task_id)
 
-    return True
-
-def generate_linkedin_post(task_id, inputs):
-    prompt = make_prompt(**inputs)
+    return bool(saved)
 
-    if config['ENABLE_LLM_GENERATION'] == 'False':
-        print("LLM generation disabled, sleeping for 10s...")
-        sleep(10)
-        save_post_to_database(task_id, None)
-        notify_personal(task_id)
-        print("Post saved for task_id: ", task_id)
-        return
-
-    input_ids = tokenizer(prompt, return_tensors="pt").input_ids.to(device)
-    with torch.no_grad():
-        output_ids = model.generate(
-            input_ids,
-            max_new_tokens=700,
-            temperature=0.5,
-            top_p=0.9,
-            do_sample=True,
-            eos_token_id=tokenizer.eos_token_id
-        )
+def mark_failed(task_id):
+    session = SessionLocal()
+    failed = session.execute(update(PostRecord)
+                             .where(claims.owned(task_id), PostRecord.status == "processing")
+                             .values(status="failed", lease_expires_at=None)).rowcount
+    session.commit()
+    session.close()
+    claims.drop(task_id)
+    if failed:
+        notify_personal(task_id, "failed")
 
-    post = tokenizer.decode(output_ids[0], skip_special_tokens=True).split("Post:")[-1].strip()
+def publish_post(task_id, post):
+    started = perf_counter()
     ok = save_post_to_database(task_id, post)
+    metrics.generation_stage.observe(perf_counter() - started, stage="db_save")
+    metrics.record_stage(task_id, "saved", perf_counter() - started)
 
     if ok:
         notify_personal(task_id)
@@ -125,9 +161,233 @@ def generate_linkedin_post(task_id, inputs):
     else:
         print("Post not saved for task_id: ", task_id)
 
+def generation_cache_key(inputs):
+    return generation_cache.cache_key(inputs, model_name, GENERATION_PARAMS)
+
+def serve_from_cache(task_id, inputs):
+    # identical inputs were generated before: write the cached post without touching the model
+    if config['ENABLE_LLM_GENERATION'] == 'False':
+        return False
+
+    post = generation_cache.lookup(generation_cache_key(inputs))
+    if post is None:
+        return False
+
+    if not save_post_to_database(task_id, post):
+        return False
+    print("Post served from generation cache for task_id: ", task_id)
+    # the webhook calls back into the app that is still waiting on this request
+    threading.Thread(target=notify_personal, args=(task_id,), daemon=True).start()
+    return True
+
+def generate_linkedin_posts(tasks):
+    """Generate posts for a batch of (task_id, inputs) pairs with one model.generate call."""
+    try:
+        run_generation(tasks)
+    finally:
+        # anything that has not been closed by now did not make it to the database
+        for task_id, _ in tasks:
+            close_stream(task_id, "failed")
+
+def run_generation(tasks):
+    streams = [open_stream(task_id) for task_id, _ in tasks] if ENABLE_STREAMING else []
+    for (task_id, _), stream in zip(tasks, streams):
+        if stream.cancelled:
+            print(f"Generation cancelled before start for task_id: {task_id}")
+            mark_failed(task_id)
+            close_stream(task_id, "cancelled")
+    if streams:
+        tasks = [task for task, stream in zip(tasks, streams) if not stream.cancelled]
+        streams = [stream for stream in streams if not stream.cancelled]
+    if not tasks:
+        return
+
+    for task_id, _ in tasks:
+        metrics.record_stage(task_id, "generating")
+
+    if config['ENABLE_LLM_GENERATION'] == 'False':
+        print(f"LLM generation disabled, sleeping for {LLM_DISABLED_DELAY_SECONDS}s...")
+        sleep(LLM_DISABLED_DELAY_SECONDS)
+        for task_id, _ in tasks:
+            publish_post(task_id, None)
+            close_stream(task_id, "done")
+        return
+
+    generator = engine.get()
+    tokenizer = generator.tokenizer
+    prompts = [make_prompt(**inputs) for _, inputs in tasks]
+    if generator.draft_model is not None:
+        output_ids, decode_seconds = generate_assisted(generator, prompts, streams)
+    else:
+        output_ids, _, decode_seconds = generate_ids(generator, prompts, streams)
+    for task_id, _ in tasks:
+        metrics.record_stage(task_id, "generated", decode_seconds)
+
+    for row, ((task_id, inputs), ids) in enumerate(zip(tasks, output_ids)):
+        if streams and streams[row].cancelled:
+            print(f"Generation cancelled for task_id: {task_id}")
+            mark_failed(task_id)
+            close_stream(task_id, "cancelled")
+            continue
+
+        post = clean_post(tokenizer.decode(ids, skip_special_tokens=True))
+        if streams:
+            streams[row].update(text=post)
+        publish_post(task_id, post)
+        generation_cache.store(generation_cache_key(inputs), post)
+        close_stream(task_id, "done")
+
+def generate_ids(generator, prompts, streams, **generate_kwargs):
+    """One model.generate call for `prompts`; returns the new token ids of every row, their count and
+    the decode time. The prompt tokens are not returned, they are never decoded again."""
+    import torch
+    from transformers import StoppingCriteriaList
+
+    tokenizer = generator.tokenizer
+    # the timer sees the prompt and then every new token, which splits prefill from decode
+    timer = metrics.StageTimer(BatchStreamer(tokenizer, streams) if streams else None)
+    with metrics.generation_stage.time(stage="tokenize"):
+        model_inputs = generator.encode(prompts)
+    prompt_length = model_inputs["input_ids"].shape[1]
+
+    # both return one flag per row, a finished or cancelled row stops while the rest keep decoding
+    stopping_criteria = StoppingCriteriaList()
+    if streams:
+        stopping_criteria.append(CancelCriteria(streams))
+    if ENABLE_POST_STOPPING:
+        stopping_criteria.append(PostStoppingCriteria(tokenizer, prompt_length))
+    with torch.inference_mode():
+        output_ids = generator.model.generate(
+            **model_inputs,
+            **GENERATION_PARAMS,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id,
+            streamer=timer,
+            stopping_criteria=stopping_criteria,
+            **generate_kwargs
+        )
+    decode_seconds = timer.observe()
+    new_ids = output_ids[:, prompt_length:]
+    new_tokens = int((new_ids != tokenizer.pad_token_id).sum())
+    metrics.generation_tokens.inc(new_tokens)
+    if decode_seconds > 0:
+        metrics.generation_tokens_per_second.set(round(new_tokens / decode_seconds, 2))
+    return new_ids, new_tokens, decode_seconds
+
+def generate_assisted(generator, prompts, streams):
+    """Generate with the draft model proposing tokens that the main model verifies in one forward pass.
+
+    Assisted generation only supports batch size 1, so the rows of the batch are generated one
+    after the other.
+    """
+    rows, seconds = [], 0.0
+    for row, prompt in enumerate(prompts):
+        model_calls, draft_calls = generator.model_calls.count, generator.draft_calls.count
+        new_ids, new_tokens, decode_seconds = generate_ids(generator, [prompt], streams[row:row + 1],
+                                                           assistant_model=generator.draft_model)
+        # every verifying pass of the main model adds one token of its own on top of the accepted ones
+        proposed = generator.draft_calls.count - draft_calls
+        accepted = max(new_tokens - (generator.model_calls.count - model_calls), 0)
+        metrics.draft_proposed_tokens.inc(proposed)
+        metrics.draft_accepted_tokens.inc(accepted)
+        if proposed:
+            metrics.draft_acceptance_rate.set(round(accepted / proposed, 3))
+            print(f"Draft acceptance {accepted}/{proposed}, {new_tokens / decode_seconds:.1f} tokens/s")
+        rows.append(new_ids[0])
+        seconds += decode_seconds
+    return rows, seconds
+
+def generate_linkedin_post(task_id, inputs):
+    generate_linkedin_posts([(task_id, inputs)])
+
+generation_queue = Queue()
+
+def collect_batch():
+    # block for the first task, then keep collecting until the window closes or the batch is full
+    batch = [generation_queue.get()]
+    deadline = monotonic() + BATCH_WINDOW_SECONDS
+    while len(batch) < BATCH_MAX_SIZE:
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(generation_queue.get(timeout=remaining))
+        except Empty:
+            break
+    return batch
+
+def batch_worker():
+    while True:
+        batch = collect_batch()
+        print(f"Generating batch of {len(batch)}: {[task_id for task_id, _, _ in batch]}")
+        try:
+            generate_linkedin_posts([(task_id, data) for task_id, data, _ in batch])
+        except Exception as e:
+            print(f"Failed to generate batch: EXP/{e}")
+            for _, _, future in batch:
+                future.set_exception(e)
+        else:
+            for _, _, future in batch:
+                future.set_result(True)
+
+def process_task(task_id, data):
+    # runs on a job thread and waits for the batch its task ends up in, so failures reach the retry logic
+    future = Future()
+    generation_queue.put((task_id, data, future))
+    future.result()
+
+def process_claimed_task(task_id, data):
+    metrics.record_stage(task_id, "queued")
+    if serve_from_cache(task_id, data):
+        return
+    if ENABLE_STREAMING:
+        open_stream(task_id)
+    process_task(task_id, data)
+
 llm = Flask(__name__)
-scheduler = BackgroundScheduler()
-scheduler.start()
+init_app(llm)
+metrics.init_app(llm, "llm")
+metrics.Gauge("generation_queue_depth", "Tasks waiting for a batch worker", fn=generation_queue.qsize)
+metrics.Gauge("scheduler_jobs_pending", "Generation jobs waiting in the scheduler",
+              fn=lambda: len(jobs.scheduler.get_jobs()) if jobs.scheduler else 0)
+http_client.start_outbox_worker()
+for worker in range(GENERATION_WORKERS):
+    threading.Thread(target=batch_worker, name=f"batch-worker-{worker}", daemon=True).start()
+if config['ENABLE_LLM_GENERATION'] == 'True' and LLM_WARMUP:
+    engine.warm_up()
+if ENABLE_CLAIM_WORKERS:
+    if config['ENABLE_SCHEDULED_GENERATION'] == 'True':
+        print("ENABLE_CLAIM_WORKERS replaces ENABLE_SCHEDULED_GENERATION, the job scheduler is not started")
+    claims.start(process_claimed_task, mark_failed, BATCH_MAX_SIZE * GENERATION_WORKERS)
+elif config['ENABLE_SCHEDULED_GENERATION'] == 'True':
+    # enough job threads to fill every worker's batch while they wait for their results
+    jobs.start(process_task, mark_failed, BATCH_MAX_SIZE * GENERATION_WORKERS)
+
+
+@llm.route('/health')
+def health():
+    return jsonify({"ok": True})
+
+
+@llm.route('/ready')
+def ready():
+    # ready once the model is loaded, or right away when generation is disabled
+    if config['ENABLE_LLM_GENERATION'] != 'True':
+        return jsonify({"ready": True, "model": "disabled"})
+
+    state = {"ready": engine.ready, "model": engine.status}
+    if engine.error:
+        state["error"] = engine.error
+    if engine.load_seconds is not None:
+        state["load_seconds"] = round(engine.load_seconds, 2)
+    if engine.ready and DRAFT_MODEL_NAME:
+        state["draft_model"] = engine.get().draft_model is not None
+    return jsonify(state), 200 if engine.ready else 503
+
+
+@llm.route('/cache/stats')
+def generation_cache_stats():
+    return jsonify(generation_cache.cache_stats())
 
 
 @llm.route('/image-edit')
@@ -146,8 +406,12 @@ def edit_image_demo():
 def generate():
     print(f"Generating Post: {request.json}")
     req_json = request.json
-    task_id = req_json["task_id"]
-    data = retrieve_task_data(int(task_id))
+    task_id = int(req_json["task_id"])
+    if ENABLE_CLAIM_WORKERS:
+        # the task stays approved, a worker claims it from the database
+        return jsonify({"ok": False, "error": "tasks are claimed from the database"}), 409
+
+    data = retrieve_task_data(task_id)
     if data == {}:
         return jsonify({"ok": False}),404
 
@@ -157,8 +421,34 @@ def generate():
         return jsonify({"ok": True})
 
     print(f"Recvd {task_id} & data: {data}")
-    scheduler.add_job(func=generate_linkedin_post, args=[task_id, data])
+    if serve_from_cache(task_id, data):
+        return jsonify({"ok": True, "cached": True})
+
+    if ENABLE_STREAMING:
+        open_stream(task_id)
+    jobs.enqueue(task_id, data)
+    metrics.record_stage(task_id, "queued")
+
+    return jsonify({"ok": True})
+
+
+@llm.route("/stream/<int:task_id>")
+def stream_task(task_id):
+    stream = get_stream(task_id)
+    if not stream:
+        return jsonify({"ok": False}), 404
+
+    return Response(stream.events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@llm.route("/cancel/<int:task_id>", methods=["POST"])
+def cancel_task(task_id):
+    stream = get_stream(task_id)
+    if not stream:
+        return jsonify({"ok": False}), 404
 
+    print(f"Cancelling generation for task_id: {task_id}")
+    stream.cancel()
     return jsonify({"ok": True})
 
 
@@ -0,0 +1,220 @@
+"""Process-local metrics in the Prometheus text format, plus per-task stage timestamps."""
+import datetime
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+from flask import request, g, Response
+
+from models import SessionLocal, TaskStageRecord, engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+GENERATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600)
+
+registry = []
+
+
+def label_key(labelnames, labels):
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def format_labels(labelnames, key, extra=()):
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, key)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = label_key(self.labelnames, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            return self.header() + [f"{self.name}{format_labels(self.labelnames, key)} {value}"
+                                    for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), fn=None):
+        super().__init__(name, documentation, labelnames)
+        self.fn = fn  # read at scrape time, for values that already live elsewhere
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[label_key(self.labelnames, labels)] = value
+
+    def render(self):
+        if self.fn:
+            try:
+                return self.header() + [f"{self.name} {self.fn()}"]
+            except Exception:
+                return []
+        with self.lock:
+            return self.header() + [f"{self.name}{format_labels(self.labelnames, key)} {value}"
+                                    for key, value in self.values.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = label_key(self.labelnames, labels)
+        with self.lock:
+            state = self.values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - started, **labels)
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                for bound, bucket_count in list(zip(self.buckets, counts)) + [("+Inf", count)]:
+                    le = 'le="%s"' % bound
+                    lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, [le])} {bucket_count}")
+                lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+request_latency = Histogram("http_request_duration_seconds", "Request latency per route",
+                            ("service", "route", "method", "status"))
+generation_stage = Histogram("generation_stage_seconds", "Time per generation stage and batch",
+                             ("stage",), GENERATION_BUCKETS)
+generation_tokens = Counter("generation_tokens_total", "Tokens generated")
+generation_tokens_per_second = Gauge("generation_tokens_per_second", "Decode throughput of the last batch")
+draft_proposed_tokens = Counter("draft_proposed_tokens_total", "Tokens proposed by the draft model")
+draft_accepted_tokens = Counter("draft_accepted_tokens_total", "Draft tokens accepted by the main model")
+draft_acceptance_rate = Gauge("draft_acceptance_rate",
+                              "Share of draft tokens accepted in the last assisted generation")
+image_prep = Histogram("image_prep_seconds", "prepare_linkedin_image / rendition duration per image", ("mode",))
+image_cache_lookups = Counter("image_cache_lookups_total", "Prepared image cache hits and misses", ("result",))
+smtp_send = Histogram("smtp_send_seconds", "Time to hand one mail to the SMTP server")
+db_pool_checked_out = Gauge("db_pool_checked_out", "Database connections in use", fn=lambda: engine.pool.checkedout())
+db_pool_size = Gauge("db_pool_size", "Database pool size", fn=lambda: engine.pool.size())
+db_pool_overflow = Gauge("db_pool_overflow", "Database connections above the pool size",
+                         fn=lambda: max(engine.pool.overflow(), 0))
+
+
+def init_app(app, service):
+    """Time every request of `app` and serve /metrics."""
+
+    @app.before_request
+    def start_timer():
+        g.request_started = perf_counter()
+
+    @app.after_request
+    def observe_latency(response):
+        started = g.pop("request_started", None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            request_latency.observe(perf_counter() - started, service=service, route=route, method=request.method,
+                                    status=response.status_code)
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(render(), mimetype="text/plain; version=0.0.4")
+
+
+def record_stage(task_id, stage, duration=None):
+    """Store when a task reached `stage` (requested / approved / queued / generating / generated / saved /
+    notified), so slow posts can be traced end to end."""
+    session = SessionLocal()
+    try:
+        session.add(TaskStageRecord(task_id=int(task_id), stage=stage, at=datetime.datetime.now(),
+                                    duration_ms=None if duration is None else int(duration * 1000)))
+        session.commit()
+    except Exception as e:
+        print(f"Failed to record stage {stage} for task_id {task_id}: EXP/{e}")
+    finally:
+        session.close()
+
+
+def task_trace(task_id):
+    session = SessionLocal()
+    records = session.query(TaskStageRecord).filter_by(task_id=task_id).order_by(TaskStageRecord.at,
+                                                                                 TaskStageRecord.id).all()
+    session.close()
+
+    trace, previous = [], None
+    for record in records:
+        trace.append({
+            "stage": record.stage,
+            "at": record.at.isoformat(),
+            "since_previous_ms": int((record.at - previous).total_seconds() * 1000) if previous else None,
+            "duration_ms": record.duration_ms,
+        })
+        previous = record.at
+    return trace
+
+
+class StageTimer:
+    """model.generate streamer that splits generation into prefill (prompt -> first token) and decode,
+    forwarding to an optional inner streamer."""
+
+    def __init__(self, inner=None):
+        self.inner = inner
+        self.started = perf_counter()
+        self.first_token = None
+        self.calls = 0
+
+    def put(self, value):
+        self.calls += 1
+        if self.calls == 2:
+            self.first_token = perf_counter()
+        if self.inner:
+            self.inner.put(value)
+
+    def end(self):
+        self.ended = perf_counter()
+        if self.inner:
+            self.inner.end()
+
+    def observe(self):
+        ended = getattr(self, "ended", perf_counter())
+        first = self.first_token or ended
+        generation_stage.observe(first - self.started, stage="prefill")
+        generation_stage.observe(ended - first, stage="decode")
+        return ended - first
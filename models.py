@@ -1,22 +1,57 @@
 import datetime
 
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, desc
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Index, desc, inspect, text, \
+    literal_column
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker, declarative_base, scoped_session
 from dotenv import dotenv_values
 
 config = dotenv_values(".env")
 
-engine = create_engine(config["DATABASE_URI"])
+
+def engine_options(uri):
+    # pre-ping drops connections the server closed while idle instead of failing the next request
+    options = {"pool_pre_ping": config.get('DB_POOL_PRE_PING', 'True') == 'True'}
+    url = make_url(uri)
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return options  # single shared in-memory connection, nothing to size
+
+    options.update(
+        pool_size=int(config.get('DB_POOL_SIZE', 10)),
+        max_overflow=int(config.get('DB_MAX_OVERFLOW', 20)),
+        pool_timeout=float(config.get('DB_POOL_TIMEOUT', 30)),
+        pool_recycle=int(config.get('DB_POOL_RECYCLE', 1800)),
+    )
+    return options
+
+
+engine = create_engine(config["DATABASE_URI"], **engine_options(config["DATABASE_URI"]))
 Base = declarative_base()
 SessionLocal = sessionmaker(bind=engine)
+# thread-local session for request handlers, removed again when the request ends (see init_app)
+db_session = scoped_session(SessionLocal)
+
+
+def init_app(app):
+    @app.teardown_appcontext
+    def remove_db_session(exception=None):
+        db_session.remove()
 
 
 class OTPRecord(Base):
     __tablename__ = "OTPRecord"
     id = Column(Integer, primary_key=True)
     code = Column(Integer)
-    timestamp = Column(DateTime, default=datetime.datetime.now())
+    timestamp = Column(DateTime, default=datetime.datetime.now)
     task_id = Column(Integer)  # no need for full relationship for now
+    attempts = Column(Integer, default=0)
+
+    __table_args__ = (
+        # verify() looks up the latest code of a task
+        Index("ix_otp_task_id_timestamp", "task_id", "timestamp", "id"),
+        # the purge job deletes expired codes
+        Index("ix_otp_timestamp", "timestamp"),
+    )
 
 
 class PostRecord(Base):
@@ -34,6 +69,22 @@ class PostRecord(Base):
         String(50), default="queued"
     )  # queued / approved / processing / done / failed
     posttype = Column(String(50), default="regular") # regular / messe / ILP
+    # bumped by every ORM/Core update, the ETag of the post; rows from before the column was added are NULL
+    version = Column(Integer, default=1, onupdate=literal_column("coalesce(version, 0) + 1"))
+    updated_at = Column(DateTime, default=datetime.datetime.now, onupdate=datetime.datetime.now)
+    # generation lease of claiming workers (see claims.py); an approved row with a lease is backing off
+    claimed_by = Column(String(100))
+    lease_expires_at = Column(DateTime)
+    heartbeat_at = Column(DateTime)
+    attempts = Column(Integer)
+
+    __table_args__ = (
+        # status/posttype filters of the listing, ordered by the id cursor
+        Index("ix_posts_status_id", "status", "id"),
+        Index("ix_posts_posttype_id", "posttype", "id"),
+        # claimable and expired rows of the claiming workers
+        Index("ix_posts_status_lease", "status", "lease_expires_at"),
+    )
 
     def dict(self):
         return {
@@ -66,5 +117,88 @@ class PostRecord(Base):
         }
 
 
-if __name__ == "__main__":
+class MailRecord(Base):
+    __tablename__ = "mail_outbox"
+    id = Column(Integer, primary_key=True)
+    subject = Column(String(255))
+    to_addr = Column(String(255))
+    from_addr = Column(String(255))
+    content = Column(Text)
+    status = Column(String(20), default="queued")  # queued / sending / sent / failed
+    attempts = Column(Integer, default=0)
+    last_error = Column(Text)
+    created_at = Column(DateTime, default=datetime.datetime.now)
+    next_attempt_at = Column(DateTime, default=datetime.datetime.now)
+    sent_at = Column(DateTime)
+
+    __table_args__ = (
+        Index("ix_mail_outbox_status_next_attempt", "status", "next_attempt_at"),
+    )
+
+
+class DeliveryRecord(Base):
+    __tablename__ = "http_outbox"
+    id = Column(Integer, primary_key=True)
+    url = Column(String(500))
+    payload = Column(Text)  # json body
+    status = Column(String(20), default="queued")  # queued / sending / sent / failed
+    attempts = Column(Integer, default=0)
+    last_error = Column(Text)
+    created_at = Column(DateTime, default=datetime.datetime.now)
+    next_attempt_at = Column(DateTime, default=datetime.datetime.now)
+    sent_at = Column(DateTime)
+
+    __table_args__ = (
+        Index("ix_http_outbox_status_next_attempt", "status", "next_attempt_at"),
+    )
+
+
+class GenerationCacheRecord(Base):
+    __tablename__ = "generation_cache"
+    key = Column(String(64), primary_key=True)  # sha256 of normalized prompt inputs, model and sampling params
+    post = Column(Text)
+    created_at = Column(DateTime, default=datetime.datetime.now)
+    last_hit_at = Column(DateTime, default=datetime.datetime.now)
+    hits = Column(Integer, default=0)
+
+
+class TaskStageRecord(Base):
+    __tablename__ = "task_stages"
+    id = Column(Integer, primary_key=True)
+    task_id = Column(Integer)
+    stage = Column(String(30))  # requested / approved / queued / generating / generated / saved / notified
+    at = Column(DateTime, default=datetime.datetime.now)
+    duration_ms = Column(Integer)  # time spent in the stage itself, where it is measured
+
+    __table_args__ = (
+        Index("ix_task_stages_task_id_at", "task_id", "at"),
+    )
+
+
+def migrate():
+    """Bring an existing database up to date with the models.
+
+    New tables are created, columns added to the models since are ALTERed in (nullable, without
+    server defaults) and missing indexes are built. Safe to run repeatedly.
+    """
     Base.metadata.create_all(engine)
+
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    print(f"Adding column {table.name}.{column.name}")
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} "
+                                      f"{column.type.compile(dialect=engine.dialect)}"))
+
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    print(f"Creating index {index.name}")
+                    index.create(bind=conn)
+
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,189 @@
+"""Approval OTPs: issued by /init-approve, consumed by /approve.
+
+OTP_STORE=sql (the default) keeps codes in the OTPRecord table, OTP_STORE=memory in an in-process TTL
+map. Either way a code expires after OTP_TTL_SECONDS, is accepted only once and is dropped after
+OTP_MAX_ATTEMPTS wrong guesses. The memory store only works while /init-approve and /approve are
+served by the same process, so only opt into it for a single app process.
+"""
+import datetime
+import threading
+from time import monotonic, sleep
+
+from dotenv import dotenv_values
+from sqlalchemy import update, delete, func, desc
+
+from models import SessionLocal, OTPRecord
+
+config = dotenv_values(".env")
+
+OTP_STORE = config.get('OTP_STORE', 'sql')
+OTP_TTL_SECONDS = int(config.get('OTP_TTL_SECONDS', 600))
+OTP_MAX_ATTEMPTS = int(config.get('OTP_MAX_ATTEMPTS', 5))
+OTP_PURGE_SECONDS = float(config.get('OTP_PURGE_SECONDS', 300))
+
+
+class TTLMap:
+    """Thread-safe dict with per-key expiry, implementing the few Redis commands the OTP store uses
+    (set with ex, get, getdel, incr, expire, delete), so a Redis client can stand in for it."""
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def _live(self, key):
+        item = self.items.get(key)
+        if item is not None and item[1] is not None and item[1] <= monotonic():
+            del self.items[key]
+            return None
+        return item
+
+    def set(self, key, value, ex=None):
+        with self.lock:
+            self.items[key] = (str(value), None if ex is None else monotonic() + ex)
+        return True
+
+    def get(self, key):
+        with self.lock:
+            item = self._live(key)
+            return item[0] if item else None
+
+    def getdel(self, key):
+        with self.lock:
+            item = self._live(key)
+            if item is None:
+                return None
+            del self.items[key]
+            return item[0]
+
+    def incr(self, key):
+        # like Redis, an existing expiry is kept
+        with self.lock:
+            item = self._live(key)
+            value = int(item[0]) + 1 if item else 1
+            self.items[key] = (str(value), item[1] if item else None)
+            return value
+
+    def expire(self, key, seconds):
+        with self.lock:
+            item = self._live(key)
+            if item is None:
+                return False
+            self.items[key] = (item[0], monotonic() + seconds)
+            return True
+
+    def delete(self, *keys):
+        with self.lock:
+            return sum(1 for key in keys if self.items.pop(key, None) is not None)
+
+    def purge(self):
+        """Drop expired keys nobody read again; returns how many."""
+        now = monotonic()
+        with self.lock:
+            expired = [key for key, (_, expires) in self.items.items() if expires is not None and expires <= now]
+            for key in expired:
+                del self.items[key]
+        return len(expired)
+
+
+class KeyValueOTPStore:
+    """Codes in a TTLMap or anything with the same Redis-style interface."""
+
+    def __init__(self, kv):
+        self.kv = kv
+
+    def issue(self, task_id, code):
+        # a new code replaces the previous one of the task, together with its attempt count
+        self.kv.set(f"otp:{task_id}", code, ex=OTP_TTL_SECONDS)
+        self.kv.set(f"otp:{task_id}:attempts", 0, ex=OTP_TTL_SECONDS)
+
+    def verify(self, task_id, code):
+        key, attempts_key = f"otp:{task_id}", f"otp:{task_id}:attempts"
+        stored = self.kv.get(key)
+        if stored is None:
+            return False
+        attempts = self.kv.incr(attempts_key)
+        if attempts == 1:
+            # incr creates the key without expiry when it ran out or was consumed since the get
+            self.kv.expire(attempts_key, OTP_TTL_SECONDS)
+        if attempts > OTP_MAX_ATTEMPTS:
+            self.kv.delete(key, attempts_key)
+            return False
+        if int(stored) != code:
+            return False
+
+        # of two requests with the right code only the one that removes it succeeds
+        consumed = self.kv.getdel(key)
+        self.kv.delete(attempts_key)
+        return consumed is not None and int(consumed) == code
+
+    def purge(self):
+        return self.kv.purge() if hasattr(self.kv, "purge") else 0
+
+
+class SqlOTPStore:
+    """Codes as OTPRecord rows; the latest unexpired row of a task is the valid one."""
+
+    def issue(self, task_id, code):
+        session = SessionLocal()
+        session.add(OTPRecord(code=code, task_id=task_id))
+        session.commit()
+        session.close()
+
+    def verify(self, task_id, code):
+        oldest = datetime.datetime.now() - datetime.timedelta(seconds=OTP_TTL_SECONDS)
+        session = SessionLocal()
+        try:
+            record = session.query(OTPRecord.id, OTPRecord.code).filter(
+                OTPRecord.task_id == task_id, OTPRecord.timestamp >= oldest).order_by(
+                desc(OTPRecord.timestamp), desc(OTPRecord.id)).first()
+            if not record:
+                return False
+
+            counted = session.execute(update(OTPRecord)
+                                      .where(OTPRecord.id == record.id,
+                                             func.coalesce(OTPRecord.attempts, 0) < OTP_MAX_ATTEMPTS)
+                                      .values(attempts=func.coalesce(OTPRecord.attempts, 0) + 1)).rowcount
+            if not counted or record.code != code:
+                session.commit()
+                return False
+
+            consumed = session.execute(delete(OTPRecord).where(OTPRecord.id == record.id)).rowcount
+            # older codes of the task are of no use any more
+            session.execute(delete(OTPRecord).where(OTPRecord.task_id == task_id))
+            session.commit()
+            return bool(consumed)
+        finally:
+            session.close()
+
+    def purge(self):
+        oldest = datetime.datetime.now() - datetime.timedelta(seconds=OTP_TTL_SECONDS)
+        session = SessionLocal()
+        try:
+            purged = session.execute(delete(OTPRecord).where(OTPRecord.timestamp < oldest)).rowcount
+            session.commit()
+            return purged
+        finally:
+            session.close()
+
+
+store = KeyValueOTPStore(TTLMap()) if OTP_STORE == 'memory' else SqlOTPStore()
+purger = None
+
+
+def purge_loop():
+    while True:
+        sleep(OTP_PURGE_SECONDS)
+        try:
+            purged = store.purge()
+            if purged:
+                print(f"Purged {purged} expired OTPs")
+        except Exception as e:
+            print(f"Failed to purge expired OTPs: EXP/{e}")
+
+
+def start_purger():
+    global purger
+    if purger is None:
+        purger = threading.Thread(target=purge_loop, name="otp-purge", daemon=True)
+        purger.start()
+    return purger
@@ -0,0 +1,177 @@
+import datetime
+import threading
+from email.message import EmailMessage
+from smtplib import SMTP, SMTPException, SMTPServerDisconnected, SMTPRecipientsRefused, SMTPSenderRefused, \
+    SMTPDataError
+
+from dotenv import dotenv_values
+
+import metrics
+from models import SessionLocal, MailRecord
+
+config = dotenv_values(".env")
+
+MAIL_BATCH_SIZE = int(config.get('MAIL_BATCH_SIZE', 20))
+MAIL_POLL_SECONDS = float(config.get('MAIL_POLL_SECONDS', 5))
+MAIL_MAX_ATTEMPTS = int(config.get('MAIL_MAX_ATTEMPTS', 5))
+MAIL_RETRY_BACKOFF_SECONDS = float(config.get('MAIL_RETRY_BACKOFF_SECONDS', 30))
+# the authenticated connection is kept open between batches until it has been idle this long
+MAIL_IDLE_SECONDS = float(config.get('MAIL_IDLE_SECONDS', 60))
+# a claimed mail's next_attempt_at is its lease: still `sending` after this long, its sender died
+MAIL_SENDING_TIMEOUT_SECONDS = float(config.get('MAIL_SENDING_TIMEOUT_SECONDS', 600))
+EMAIL_STARTTLS = config.get('EMAIL_STARTTLS', 'True') == 'True'
+
+
+def enqueue_mail(content, subject, to_addr, from_addr):
+    """Queue a mail in the outbox; the MailSender thread delivers it."""
+    session = SessionLocal()
+    try:
+        session.add(MailRecord(content=content, subject=subject, to_addr=to_addr, from_addr=from_addr))
+        session.commit()
+    except Exception as e:
+        print("failed to queue email: ", e)
+        return False
+    finally:
+        session.close()
+
+    if sender:
+        sender.wake.set()
+    return True
+
+
+def build_message(record):
+    msg = EmailMessage()
+    msg.set_content(record.content)
+    msg['Subject'] = record.subject
+    msg['From'] = record.from_addr
+    msg['To'] = record.to_addr
+    return msg
+
+
+class MailSender(threading.Thread):
+    """Delivers queued mails in batches over one persistent, authenticated SMTP connection."""
+
+    def __init__(self):
+        super().__init__(name="mail-sender", daemon=True)
+        self.wake = threading.Event()
+        self.smtp = None
+        self.last_used = None
+
+    def connect(self):
+        if self.smtp is None:
+            smtp = SMTP(host=config['EMAIL_SERVER'], port=int(config['EMAIL_PORT']), timeout=30)
+            if EMAIL_STARTTLS:
+                smtp.starttls()
+            if config.get('EMAIL_PASSWORD'):
+                smtp.login(config['EMAIL_USER'], config['EMAIL_PASSWORD'])
+            self.smtp = smtp
+        return self.smtp
+
+    def disconnect(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (SMTPException, OSError):
+                pass
+            self.smtp = None
+
+    def deliver(self, msg):
+        # a connection that went stale while idle is reopened once before giving up
+        for attempt in (1, 2):
+            try:
+                with metrics.smtp_send.time():
+                    self.connect().sendmail(config['EMAIL_USER'], config['EMAIL_USER'], msg.as_string())
+                self.last_used = datetime.datetime.now()
+                return
+            except (SMTPServerDisconnected, ConnectionError):
+                self.smtp = None
+                if attempt == 2:
+                    raise
+
+    def claim_batch(self):
+        # due mails, and mails whose sender stopped before finishing them
+        now = datetime.datetime.now()
+        due = (MailRecord.status.in_(("queued", "sending")), MailRecord.next_attempt_at <= now)
+        lease = now + datetime.timedelta(seconds=MAIL_SENDING_TIMEOUT_SECONDS)
+
+        session = SessionLocal()
+        candidates = session.query(MailRecord.id) \
+            .filter(*due) \
+            .order_by(MailRecord.id) \
+            .limit(MAIL_BATCH_SIZE) \
+            .all()
+        claimed = []
+        for mail_id, in candidates:
+            # compare-and-set, another app process may be sending the same outbox
+            updated = session.query(MailRecord).filter(MailRecord.id == mail_id, *due) \
+                .update({"status": "sending", "next_attempt_at": lease}, synchronize_session=False)
+            if updated:
+                claimed.append(mail_id)
+        session.commit()
+        records = session.query(MailRecord).filter(MailRecord.id.in_(claimed)).order_by(MailRecord.id).all()
+        return session, records
+
+    def send_batch(self):
+        session, records = self.claim_batch()
+        try:
+            for record in records:
+                try:
+                    self.deliver(build_message(record))
+                except (SMTPRecipientsRefused, SMTPSenderRefused, SMTPDataError) as e:
+                    # only this message was rejected, the connection is fine for the rest
+                    self.failed(record, e)
+                except (SMTPException, OSError) as e:
+                    # the server is unreachable, the rest of the batch would fail the same way
+                    self.failed(record, e)
+                    for pending in records[records.index(record) + 1:]:
+                        pending.status = "queued"
+                        pending.next_attempt_at = datetime.datetime.now()
+                    break
+                except Exception as e:
+                    # anything else is a problem with this message, it must not stay `sending`
+                    self.failed(record, e)
+                else:
+                    record.status = "sent"
+                    record.sent_at = datetime.datetime.now()
+                    record.attempts += 1
+            session.commit()
+        finally:
+            session.close()
+        return len(records)
+
+    def failed(self, record, error):
+        print("failed to send email: ", error)
+        record.attempts += 1
+        record.last_error = str(error)
+        if record.attempts >= MAIL_MAX_ATTEMPTS:
+            record.status = "failed"
+            return
+        record.status = "queued"
+        record.next_attempt_at = datetime.datetime.now() + datetime.timedelta(
+            seconds=MAIL_RETRY_BACKOFF_SECONDS * 2 ** (record.attempts - 1))
+
+    def run(self):
+        while True:
+            self.wake.wait(timeout=MAIL_POLL_SECONDS)
+            self.wake.clear()
+            try:
+                while self.send_batch() == MAIL_BATCH_SIZE:
+                    pass
+            except Exception as e:
+                print("failed to proceed: ", e)
+
+            idle = self.last_used and datetime.datetime.now() - self.last_used
+            if idle and idle.total_seconds() > MAIL_IDLE_SECONDS:
+                self.disconnect()
+                self.last_used = None
+
+
+sender = None
+
+
+def start_sender():
+    global sender
+    if sender is None:
+        sender = MailSender()
+        sender.start()
+    return sender
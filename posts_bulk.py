@@ -0,0 +1,240 @@
+"""Bulk import and export of posts as JSONL or CSV.
+
+    python posts_bulk.py import events.csv [--dry-run]
+    python posts_bulk.py export -o posts.jsonl [--status done] [--fields event_title,date,post]
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+
+from dotenv import dotenv_values
+from flask import jsonify, Response, stream_with_context
+from sqlalchemy import insert
+
+import search
+from models import SessionLocal, PostRecord
+from posts_db import LISTABLE_FIELDS, iter_posts, parse_listing_args
+
+config = dotenv_values(".env")
+
+IMPORT_CHUNK_SIZE = int(config.get('IMPORT_CHUNK_SIZE', 1000))
+# the summary lists at most this many row errors, the counts are always complete
+MAX_REPORTED_ERRORS = 1000
+FORMATS = ("jsonl", "csv")
+
+IMPORTABLE_FIELDS = tuple(field for field in LISTABLE_FIELDS if field != "id")
+STATUSES = ("queued", "approved", "processing", "done", "failed")
+POSTTYPES = ("regular", "messe", "ILP")
+
+
+def detect_format(filename, requested=None):
+    fmt = (requested or (filename or "").rsplit(".", 1)[-1]).lower()
+    if fmt == "json":
+        fmt = "jsonl"
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    return fmt
+
+
+def read_rows(stream, fmt):
+    """Yield (line, row or exception) from a text stream, one row at a time."""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            # empty CSV cells mean "not given", not an empty string
+            yield reader.line_num, {key: value for key, value in row.items() if value not in ("", None)}
+        return
+
+    for line, text in enumerate(stream, start=1):
+        if not text.strip():
+            continue
+        try:
+            yield line, json.loads(text)
+        except ValueError as e:
+            yield line, ValueError(f"invalid JSON: {e}")
+
+
+def validate(row):
+    """Return the insert values of a row, or raise ValueError."""
+    if not isinstance(row, dict):
+        raise ValueError("row must be an object")
+    # ids are assigned on insert, an export can be imported again as is
+    row = {key: value for key, value in row.items() if key != "id"}
+    unknown = set(row) - set(IMPORTABLE_FIELDS)
+    if unknown:
+        raise ValueError(f"unknown field(s): {', '.join(sorted(map(str, unknown)))}")
+    if not row.get("event_title"):
+        raise ValueError("event_title is required")
+
+    values = {}
+    for field in IMPORTABLE_FIELDS:
+        value = row.get(field)
+        if value is not None and not isinstance(value, str):
+            value = str(value)
+        length = getattr(PostRecord.__table__.c[field].type, "length", None)
+        if value is not None and length and len(value) > length:
+            raise ValueError(f"{field} is longer than {length} characters")
+        values[field] = value
+
+    # every row carries the same keys, so the defaults are filled in here rather than by the column
+    values["status"] = values["status"] or PostRecord.status.default.arg
+    values["posttype"] = values["posttype"] or PostRecord.posttype.default.arg
+    if values["status"] not in STATUSES:
+        raise ValueError(f"status must be one of {', '.join(STATUSES)}")
+    if values["posttype"] not in POSTTYPES:
+        raise ValueError(f"posttype must be one of {', '.join(POSTTYPES)}")
+    return values
+
+
+def insert_chunk(chunk):
+    """Insert [(line, values)] in one transaction and add them to the search index."""
+    session = SessionLocal()
+    try:
+        ids = session.scalars(insert(PostRecord).returning(PostRecord.id, sort_by_parameter_order=True),
+                              [values for _, values in chunk]).all()
+        session.commit()
+    finally:
+        session.close()
+    search.index_posts([(post_id, values) for post_id, (_, values) in zip(ids, chunk)])
+    return ids
+
+
+def import_rows(rows, chunk_size=IMPORT_CHUNK_SIZE, dry_run=False):
+    """Validate and insert (line, row) pairs chunk by chunk; a failing chunk does not stop the import."""
+    summary = {"rows": 0, "imported": 0, "failed": 0, "errors": []}
+
+    def failed(line, error):
+        summary["failed"] += 1
+        if len(summary["errors"]) < MAX_REPORTED_ERRORS:
+            summary["errors"].append({"line": line, "error": error})
+
+    def flush(chunk):
+        if dry_run:
+            summary["imported"] += len(chunk)
+            return
+        try:
+            summary["imported"] += len(insert_chunk(chunk))
+        except Exception as e:
+            print(f"Failed to import chunk at line {chunk[0][0]}: EXP/{e}")
+            for line, _ in chunk:
+                failed(line, f"database error: {e}")
+
+    chunk = []
+    for line, row in rows:
+        summary["rows"] += 1
+        try:
+            if isinstance(row, Exception):
+                raise row
+            chunk.append((line, validate(row)))
+        except ValueError as e:
+            failed(line, str(e))
+            continue
+        if len(chunk) >= chunk_size:
+            flush(chunk)
+            chunk = []
+    if chunk:
+        flush(chunk)
+    return summary
+
+
+def export_lines(fmt, fields, filters):
+    """Yield the export one line at a time."""
+    if fmt == "jsonl":
+        for post in iter_posts(fields, filters):
+            yield json.dumps(post) + "\n"
+        return
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+    for post in iter_posts(fields, filters):
+        writer.writerow(post)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def import_posts(request):
+    """POST /api/posts/import: a JSONL or CSV file (multipart `file`, or the raw body with ?format=).
+
+    Query args: format, chunk_size, dry_run.
+    """
+    upload = request.files.get('file')
+    try:
+        fmt = detect_format(upload.filename if upload else None, request.args.get('format'))
+        chunk_size = request.args.get('chunk_size', IMPORT_CHUNK_SIZE, type=int)
+        if not 0 < chunk_size <= 10000:
+            raise ValueError("chunk_size must be between 1 and 10000")
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # read from the upload stream line by line, the file is never held in memory as a whole
+    stream = io.TextIOWrapper(upload.stream if upload else request.stream, encoding="utf-8-sig", newline="")
+    return jsonify(import_rows(read_rows(stream, fmt), chunk_size, request.args.get('dry_run') == 'true'))
+
+
+def export_posts(args):
+    """GET /api/posts/export: every post as JSONL (default) or CSV, streamed.
+
+    Query args: format, status, posttype, fields (comma separated column names).
+    """
+    try:
+        fmt = detect_format(None, args.get('format', 'jsonl'))
+        # every column by default, like the CLI, so an export can be imported again without losing the status
+        fields, filters, _, _ = parse_listing_args(args, LISTABLE_FIELDS)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    mimetype = 'application/x-ndjson' if fmt == 'jsonl' else 'text/csv'
+    return Response(stream_with_context(export_lines(fmt, fields, filters)), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=posts.{fmt}'})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = commands.add_parser("import", help="insert posts from a JSONL or CSV file")
+    import_parser.add_argument("file")
+    import_parser.add_argument("--format", choices=FORMATS)
+    import_parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE)
+    import_parser.add_argument("--dry-run", action="store_true", help="only validate")
+
+    export_parser = commands.add_parser("export", help="write posts as JSONL or CSV")
+    export_parser.add_argument("-o", "--output", default="-")
+    export_parser.add_argument("--format", choices=FORMATS)
+    export_parser.add_argument("--status")
+    export_parser.add_argument("--posttype")
+    export_parser.add_argument("--fields", default="")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        with open(args.file, encoding="utf-8-sig", newline="") as stream:
+            rows = read_rows(stream, detect_format(args.file, args.format))
+            summary = import_rows(rows, args.chunk_size, args.dry_run)
+        print(f"Imported {summary['imported']}/{summary['rows']} rows"
+              + (" (dry run)" if args.dry_run else ""))
+        for error in summary["errors"]:
+            print(f"  line {error['line']}: {error['error']}")
+        sys.exit(1 if summary["failed"] else 0)
+
+    fmt = args.format or (detect_format(args.output) if args.output != "-" else "jsonl")
+    fields = tuple(f.strip() for f in args.fields.split(",") if f.strip()) or tuple(LISTABLE_FIELDS)
+    unknown = set(fields) - set(LISTABLE_FIELDS)
+    if unknown:
+        parser.error(f"unknown field(s): {', '.join(sorted(unknown))}")
+    filters = {key: getattr(args, key) for key in ("status", "posttype") if getattr(args, key)}
+    output = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8", newline="")
+    try:
+        for line in export_lines(fmt, fields, filters):
+            output.write(line)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
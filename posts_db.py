@@ -1,32 +1,189 @@
-from flask import jsonify
+import hashlib
+import json
 
+from flask import jsonify, Response, stream_with_context
+from sqlalchemy import func
+
+import search
 from logger import logger
-from models import SessionLocal, PostRecord
+from models import SessionLocal, PostRecord, db_session
+
+# columns the listing can project, `fields` defaults to the ones of PostRecord.api_dict (+ id)
+LISTABLE_FIELDS = ("id", "event_title", "date", "description", "good", "bad", "goal", "instructions", "post",
+                   "posttype", "status")
+DEFAULT_FIELDS = ("id", "event_title", "date", "description", "good", "bad", "goal", "instructions", "post",
+                  "posttype")
+MAX_PAGE_SIZE = 500
+STREAM_BATCH_SIZE = 1000
 
 def create_post(request):
     data = request.json
     logger.debug(f"data: {data}")
-    session = SessionLocal()
+    session = db_session()
     post = PostRecord(**data)
     session.add(post)
     session.commit()
+    search.index_post(post)
     logger.info('CREATE POST: ok.')
     return jsonify({'id': post.id}), 201
 
-def get_all_posts():
-    session = SessionLocal()
-    posts = session.query(PostRecord).all()
-    return jsonify([p.api_dict() for p in posts])
+def parse_listing_args(args, default_fields=DEFAULT_FIELDS):
+    fields = tuple(f.strip() for f in args.get('fields', '').split(',') if f.strip()) or default_fields
+    unknown = set(fields) - set(LISTABLE_FIELDS)
+    if unknown:
+        raise ValueError(f"unknown field(s): {', '.join(sorted(unknown))}")
+    if 'id' not in fields:
+        fields = ('id',) + fields  # the cursor needs it
+
+    filters = {key: args[key] for key in ('status', 'posttype') if args.get(key)}
+    limit = args.get('limit', type=int)
+    cursor = args.get('cursor', type=int)
+    if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    return fields, filters, limit, cursor
+
+
+def listing_query(session, fields, filters, cursor=None, extra=()):
+    # only the requested columns are loaded, no ORM objects with every Text column
+    query = session.query(*[getattr(PostRecord, f) for f in fields], *extra).filter_by(**filters)
+    if cursor is not None:
+        query = query.filter(PostRecord.id > cursor)
+    return query.order_by(PostRecord.id)
+
+
+def not_modified(request, etag, last_modified):
+    # checked before the payload is loaded, a matching poll costs one small query
+    if request.if_none_match.contains(etag) or \
+            (not request.if_none_match and last_modified and request.if_modified_since
+             and last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)):
+        return with_validators(Response(status=304), etag, last_modified)
+    return None
+
+
+def with_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    # the SPA may keep a copy but has to revalidate it on every poll
+    response.cache_control.no_cache = True
+    return response
+
+
+def listing_validators(session, query_string, filters):
+    """ETag and Last-Modified of the full listing: any insert, update or delete in the listed rows changes them.
+
+    Aggregates over every matching row, so only used for the unpaginated export.
+    """
+    count, max_id, versions, last_modified = session.query(
+        func.count(PostRecord.id), func.max(PostRecord.id), func.sum(func.coalesce(PostRecord.version, 0)),
+        func.max(PostRecord.updated_at)).filter_by(**filters).one()
+    etag = hashlib.sha1(f"{query_string}|{count}|{max_id}|{versions}|{last_modified}".encode()).hexdigest()
+    return etag, last_modified
+
+
+def page_validators(query_string, ids, versions, updated, next_cursor):
+    """ETag and Last-Modified of one page, from the rows it shows and whether another page follows."""
+    etag = hashlib.sha1(f"{query_string}|{ids}|{versions}|{next_cursor}".encode()).hexdigest()
+    return etag, max((at for at in updated if at), default=None)
+
+
+def get_all_posts(request):
+    """List posts, paginated when `limit` or `cursor` is given, otherwise as one streamed JSON array.
+
+    Query args: limit, cursor (id of the last post of the previous page), status, posttype,
+    fields (comma separated column names). Answers 304 to a matching If-None-Match.
+    """
+    args = request.args
+    try:
+        fields, filters, limit, cursor = parse_listing_args(args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-def get_post(id):
+    session = db_session()
+    query_string = request.query_string.decode()
+    if limit is None and cursor is None:
+        etag, last_modified = listing_validators(session, query_string, filters)
+        return not_modified(request, etag, last_modified) or \
+            with_validators(stream_posts(fields, filters), etag, last_modified)
+
+    # a page is validated from its own rows, the keyset query stays the only one
+    limit = limit or 50
+    rows = listing_query(session, fields, filters, cursor, (PostRecord.version, PostRecord.updated_at)) \
+        .limit(limit + 1).all()
+    rows, more = rows[:limit], len(rows) > limit
+
+    posts = [dict(zip(fields, row)) for row in rows]
+    next_cursor = posts[-1]['id'] if more else None
+    etag, last_modified = page_validators(query_string, [post['id'] for post in posts],
+                                          [row[-2] for row in rows], [row[-1] for row in rows], next_cursor)
+    return not_modified(request, etag, last_modified) or \
+        with_validators(jsonify({'posts': posts, 'next_cursor': next_cursor}), etag, last_modified)
+
+
+def iter_posts(fields, filters):
+    # rows are fetched STREAM_BATCH_SIZE at a time, memory stays flat however big the table gets
     session = SessionLocal()
-    post = session.query(PostRecord).get(id)
-    if not post:
+    try:
+        for row in listing_query(session, fields, filters).yield_per(STREAM_BATCH_SIZE):
+            yield dict(zip(fields, row))
+    finally:
+        session.close()
+
+
+def stream_posts(fields, filters):
+    def generate():
+        yield '['
+        for index, post in enumerate(iter_posts(fields, filters)):
+            yield (',' if index else '') + json.dumps(post)
+        yield ']'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+def search_posts(args):
+    """Ranked full-text search over event title, description and generated post.
+
+    Query args: q, limit, offset, fields (comma separated column names).
+    """
+    query = args.get('q', '').strip()
+    try:
+        fields, _, limit, _ = parse_listing_args(args)
+        offset = args.get('offset', 0, type=int)
+        if offset < 0:
+            raise ValueError("offset must not be negative")
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not query:
+        return jsonify({'error': 'q is required'}), 400
+
+    limit = limit or 20
+    hits = search.search_posts(query, limit + 1, offset)
+    scores = dict(hits[:limit])
+
+    session = db_session()
+    rows = listing_query(session, fields, {}).filter(PostRecord.id.in_(scores)).all() if scores else []
+    posts = {row[0]: dict(zip(fields, row), score=round(scores[row[0]], 4)) for row in rows}
+    return jsonify({
+        # ranked order; ids the index still knows but the table no longer has are skipped
+        'posts': [posts[post_id] for post_id, _ in hits[:limit] if post_id in posts],
+        'next_offset': offset + limit if len(hits) > limit else None,
+    })
+
+def get_post(request, id):
+    session = db_session()
+    version = session.query(PostRecord.version, PostRecord.updated_at).filter_by(id=id).first()
+    if not version:
         return jsonify({'error': 'Not found'}), 404
-    return jsonify(post.api_dict())
+
+    etag = f"{id}-{version.version or 0}"
+    response = not_modified(request, etag, version.updated_at)
+    if response:
+        return response
+
+    post = session.query(PostRecord).get(id)
+    return with_validators(jsonify(post.api_dict()), etag, version.updated_at)
 
 def update_post(request, id):
-    session = SessionLocal()
+    session = db_session()
     post = session.query(PostRecord).get(id)
     if not post:
         return jsonify({'error': 'Not found'}), 404
@@ -37,14 +194,16 @@ def update_post(request, id):
             setattr(post, key, value)
 
     session.commit()
+    search.index_post(post)
     return jsonify(post.dict())
 
 def delete_post(id):
-    session = SessionLocal()
+    session = db_session()
     post = session.query(PostRecord).get(id)
     if not post:
         return jsonify({'error': 'Not found'}), 404
 
     session.delete(post)
     session.commit()
+    search.remove_post(id)
     return jsonify({'message': 'Deleted'})
\ No newline at end of file
@@ -0,0 +1,241 @@
+"""Full-text search over posts.
+
+SQLite databases use an FTS5 table (posts_fts) next to linkedin_posts. Other databases, or SQLite
+builds without FTS5, use an inverted index held in the app process and built from the table on
+first use. Both are kept up to date by index_post/remove_post and rank with BM25, so a matching
+event title counts more than a match in the description or the generated post.
+"""
+import math
+import re
+import threading
+import unicodedata
+from collections import defaultdict, Counter
+
+from dotenv import dotenv_values
+from sqlalchemy import select, text
+
+from models import SessionLocal, PostRecord, engine
+
+config = dotenv_values(".env")
+
+# auto / fts5 / memory
+SEARCH_BACKEND = config.get('SEARCH_BACKEND', 'auto')
+# indexed columns and their BM25 weights
+SEARCH_FIELDS = (("event_title", 5.0), ("description", 2.0), ("post", 1.0))
+REBUILD_BATCH_SIZE = 1000
+
+TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(value):
+    # lowercased and without diacritics, like FTS5's unicode61 tokenizer: "München" matches "munchen"
+    value = unicodedata.normalize("NFKD", (value or "").lower())
+    return TOKEN.findall("".join(char for char in value if not unicodedata.combining(char)))
+
+
+def post_fields(post):
+    return {name: getattr(post, name) for name, _ in SEARCH_FIELDS}
+
+
+def all_posts():
+    session = SessionLocal()
+    try:
+        columns = [PostRecord.id] + [getattr(PostRecord, name) for name, _ in SEARCH_FIELDS]
+        for row in session.query(*columns).yield_per(REBUILD_BATCH_SIZE):
+            yield row[0], dict(zip([name for name, _ in SEARCH_FIELDS], row[1:]))
+    finally:
+        session.close()
+
+
+class FtsIndex:
+    name = "fts5"
+
+    def __init__(self):
+        columns = ", ".join(name for name, _ in SEARCH_FIELDS)
+        with engine.begin() as conn:
+            exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'posts_fts'")).first()
+            conn.execute(text(f"CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5({columns}, "
+                              f"tokenize = 'unicode61 remove_diacritics 2')"))
+        if not exists:
+            self.rebuild()
+
+    def rebuild(self):
+        # read through the writing connection, on SQLite a second one would wait for this transaction
+        names = [name for name, _ in SEARCH_FIELDS]
+        query = select(PostRecord.id, *[getattr(PostRecord, name) for name in names])
+        with engine.begin() as conn:
+            conn.execute(text("DELETE FROM posts_fts"))
+            for rows in conn.execute(query.execution_options(yield_per=REBUILD_BATCH_SIZE)).partitions():
+                self.insert(conn, [(row[0], dict(zip(names, row[1:]))) for row in rows])
+
+    def insert(self, conn, posts):
+        names = [name for name, _ in SEARCH_FIELDS]
+        conn.execute(text(f"INSERT INTO posts_fts (rowid, {', '.join(names)}) "
+                          f"VALUES (:id, {', '.join(':' + name for name in names)})"),
+                     [{"id": post_id, **{name: fields.get(name) or "" for name in names}}
+                      for post_id, fields in posts])
+
+    def index(self, post_id, fields):
+        self.index_many([(post_id, fields)])
+
+    def index_many(self, posts):
+        posts = list(posts)
+        if not posts:
+            return
+        with engine.begin() as conn:
+            conn.execute(text("DELETE FROM posts_fts WHERE rowid = :id"), [{"id": post_id} for post_id, _ in posts])
+            self.insert(conn, posts)
+
+    def remove(self, post_id):
+        with engine.begin() as conn:
+            conn.execute(text("DELETE FROM posts_fts WHERE rowid = :id"), {"id": post_id})
+
+    def search(self, query, limit, offset):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        # every term quoted so user input cannot use FTS5 syntax; the last one matches as a prefix
+        match = " ".join(f'"{token}"' for token in tokens) + "*"
+        weights = ", ".join(str(weight) for _, weight in SEARCH_FIELDS)
+        with engine.connect() as conn:
+            rows = conn.execute(text(f"SELECT rowid, bm25(posts_fts, {weights}) AS score FROM posts_fts "
+                                     f"WHERE posts_fts MATCH :match ORDER BY score LIMIT :limit OFFSET :offset"),
+                                {"match": match, "limit": limit, "offset": offset}).all()
+        # bm25() is negative, lower is better
+        return [(post_id, -score) for post_id, score in rows]
+
+
+class MemoryIndex:
+    """Inverted index with BM25 ranking, for databases without FTS5."""
+    name = "memory"
+    k1, b = 1.2, 0.75
+
+    def __init__(self):
+        self.postings = defaultdict(dict)  # token -> {post_id: weighted term frequency}
+        self.lengths = {}  # post_id -> weighted length
+        self.terms = {}  # post_id -> tokens, to remove a post's postings
+        self.lock = threading.Lock()
+        self.rebuild()
+
+    def rebuild(self):
+        with self.lock:
+            self.postings.clear()
+            self.lengths.clear()
+            self.terms.clear()
+        for post_id, fields in all_posts():
+            self.index(post_id, fields)
+
+    def index(self, post_id, fields):
+        frequencies, length = Counter(), 0.0
+        for name, weight in SEARCH_FIELDS:
+            tokens = tokenize(fields.get(name))
+            length += weight * len(tokens)
+            for token in tokens:
+                frequencies[token] += weight
+
+        with self.lock:
+            self.unindex(post_id)
+            for token, frequency in frequencies.items():
+                self.postings[token][post_id] = frequency
+            self.lengths[post_id] = length
+            self.terms[post_id] = tuple(frequencies)
+
+    def index_many(self, posts):
+        for post_id, fields in posts:
+            self.index(post_id, fields)
+
+    def unindex(self, post_id):
+        for token in self.terms.pop(post_id, ()):
+            self.postings[token].pop(post_id, None)
+            if not self.postings[token]:
+                del self.postings[token]
+        self.lengths.pop(post_id, None)
+
+    def remove(self, post_id):
+        with self.lock:
+            self.unindex(post_id)
+
+    def search(self, query, limit, offset):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        with self.lock:
+            count = len(self.lengths)
+            average = sum(self.lengths.values()) / count if count else 0
+            scores, matched = defaultdict(float), None
+            for position, token in enumerate(tokens):
+                # the last term matches as a prefix, like the FTS5 query
+                if position == len(tokens) - 1:
+                    variants = [term for term in self.postings if term.startswith(token)]
+                else:
+                    variants = [token] if token in self.postings else []
+                hits = set()
+                for term in variants:
+                    postings = self.postings[term]
+                    idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for post_id, frequency in postings.items():
+                        norm = frequency + self.k1 * (1 - self.b + self.b * self.lengths[post_id] / (average or 1))
+                        scores[post_id] += idf * frequency * (self.k1 + 1) / norm
+                        hits.add(post_id)
+                # every term has to match
+                matched = hits if matched is None else matched & hits
+
+        ranked = sorted(((post_id, scores[post_id]) for post_id in matched), key=lambda hit: (-hit[1], hit[0]))
+        return ranked[offset:offset + limit]
+
+
+index = None
+index_lock = threading.Lock()
+
+
+def fts5_available():
+    if engine.dialect.name != "sqlite":
+        return False
+    with engine.connect() as conn:
+        options = {row[0] for row in conn.execute(text("PRAGMA compile_options"))}
+    return "ENABLE_FTS5" in options
+
+
+def get_index():
+    global index
+    with index_lock:
+        if index is None:
+            use_fts = SEARCH_BACKEND == "fts5" or (SEARCH_BACKEND == "auto" and fts5_available())
+            index = FtsIndex() if use_fts else MemoryIndex()
+            print(f"Search index: {index.name}")
+        return index
+
+
+def index_post(post):
+    """Add or refresh a PostRecord (or a post id) in the search index."""
+    try:
+        if isinstance(post, int):
+            session = SessionLocal()
+            post = session.query(PostRecord).get(post)
+            session.close()
+            if post is None:
+                return
+        get_index().index(post.id, post_fields(post))
+    except Exception as e:
+        print(f"Failed to index post: EXP/{e}")
+
+
+def index_posts(posts):
+    """Add or refresh many (post_id, {field: value}) pairs at once, e.g. after a bulk import."""
+    try:
+        get_index().index_many(posts)
+    except Exception as e:
+        print(f"Failed to index posts: EXP/{e}")
+
+
+def remove_post(post_id):
+    try:
+        get_index().remove(post_id)
+    except Exception as e:
+        print(f"Failed to remove post {post_id} from search index: EXP/{e}")
+
+
+def search_posts(query, limit, offset):
+    """Return [(post_id, score)] for `query`, best match first."""
+    return get_index().search(query, limit, offset)
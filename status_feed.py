@@ -0,0 +1,114 @@
+"""In-process fan-out of post status changes to long-poll and SSE subscribers.
+
+The status webhook of the llm service publishes every change here; waiting clients block on a
+per-task condition instead of re-querying PostRecord. Each subscriber reads the database once to
+learn the current status, and again only when its wait times out, in case the change was
+delivered to another app process.
+"""
+import json
+import threading
+from collections import OrderedDict
+
+from models import SessionLocal, PostRecord
+
+FINAL_STATUSES = ("done", "failed")
+# statuses remembered for tasks nobody is waiting on, the oldest are forgotten first
+MAX_KNOWN_TASKS = 10000
+
+
+class TaskStatus:
+    def __init__(self, status):
+        self.status = status
+        self.version = 0
+        self.waiters = 0
+        self.cond = threading.Condition()
+
+    def update(self, status):
+        with self.cond:
+            if status != self.status:
+                self.status = status
+                self.version += 1
+                self.cond.notify_all()
+
+
+tasks = OrderedDict()
+tasks_lock = threading.Lock()
+
+
+def read_status(task_id):
+    session = SessionLocal()
+    row = session.query(PostRecord.status).filter_by(id=task_id).first()
+    session.close()
+    return row.status if row else None
+
+
+def get_task(task_id):
+    with tasks_lock:
+        task = tasks.get(task_id)
+        if task is not None:
+            tasks.move_to_end(task_id)
+            return task
+
+    status = read_status(task_id)
+    if status is None:
+        return None
+    with tasks_lock:
+        task = tasks.setdefault(task_id, TaskStatus(status))
+        while len(tasks) > MAX_KNOWN_TASKS:
+            oldest = next(iter(tasks))
+            if tasks[oldest].waiters:
+                tasks.move_to_end(oldest)
+                break
+            del tasks[oldest]
+        return task
+
+
+def publish(task_id, status):
+    with tasks_lock:
+        task = tasks.get(task_id)
+    # nobody has asked about the task yet, the first subscriber reads it from the database
+    if task is not None:
+        task.update(status)
+
+
+def wait_for_change(task_id, known=None, timeout=30):
+    """Return the status of a task once it differs from `known`, or after `timeout` seconds.
+
+    None if the task does not exist.
+    """
+    task = get_task(task_id)
+    if task is None:
+        return None
+
+    with task.cond:
+        task.waiters += 1
+        try:
+            if task.status == known and task.status not in FINAL_STATUSES:
+                task.cond.wait(timeout)
+            changed = task.status != known
+        finally:
+            task.waiters -= 1
+
+    if not changed:
+        # the change may have reached another app process
+        task.update(read_status(task_id) or task.status)
+    return task.status
+
+
+def events(task_id, keepalive=15):
+    """SSE stream of the status of a task, ending with its final status."""
+    known = None
+    while True:
+        status = wait_for_change(task_id, known, keepalive)
+        if status is None:
+            return
+        if status == known:
+            yield ": keep-alive\n\n"
+            continue
+
+        known = status
+        payload = json.dumps({"task_id": task_id, "status": status})
+        if status in FINAL_STATUSES:
+            yield f"event: {status}\ndata: {payload}\n\n"
+            return
+        yield f"data: {payload}\n\n"
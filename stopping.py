@@ -0,0 +1,73 @@
+"""Stopping criteria that end decoding once a row holds a finished post, and the matching clean-up."""
+import re
+from functools import lru_cache
+
+from dotenv import dotenv_values
+
+config = dotenv_values(".env")
+
+# the word budget leaves some room over the 200 words the prompt asks for, hashtags are not counted
+POST_WORD_BUDGET = int(config.get('POST_WORD_BUDGET', 250))
+POST_HASHTAGS = int(config.get('POST_HASHTAGS', 3))
+# hashtags only close a post after this many words of body, leading hashtags are no finished post
+POST_MIN_WORDS = int(config.get('POST_MIN_WORDS', 20))
+# the prompt ends in this marker; the model writing it again starts a second post
+POST_MARKER = "Post:"
+
+
+@lru_cache(maxsize=8)
+def hashtag_block(count):
+    # `count` hashtags on their own line(s) at the very end, the last one finished by whitespace
+    return re.compile(r"(?:^|\n)[ \t]*#\w+(?:\s+#\w+){%d,}\s+$" % (count - 1))
+
+
+def strip_marker(text):
+    # a leading marker is the model restating the prompt, the post follows it
+    text = text.lstrip()
+    return text[len(POST_MARKER):] if text.startswith(POST_MARKER) else text
+
+
+def count_words(text):
+    return sum(1 for word in text.split() if not word.startswith("#"))
+
+
+def closing_hashtags(text, hashtags=POST_HASHTAGS, min_words=POST_MIN_WORDS):
+    block = hashtag_block(hashtags).search(text)
+    return block is not None and count_words(text[:block.start()]) >= min_words
+
+
+def finished_post(text, word_budget=POST_WORD_BUDGET, hashtags=POST_HASHTAGS, min_words=POST_MIN_WORDS):
+    """True once the generated text holds a complete post and further tokens would be thrown away."""
+    text = strip_marker(text)
+    return (POST_MARKER in text
+            or count_words(text) >= word_budget
+            or closing_hashtags(text, hashtags, min_words))
+
+
+def clean_post(text):
+    """The post within the generated text: without a restated marker and anything after a second one."""
+    return strip_marker(text).split(POST_MARKER)[0].strip()
+
+
+class PostStoppingCriteria:
+    """Per-row stopping criteria: word budget, closing hashtag block and a repeated "Post:".
+
+    Only the tokens after `prompt_length` are decoded, once per row and step, and rows that are
+    done are not decoded again.
+    """
+
+    def __init__(self, tokenizer, prompt_length, word_budget=POST_WORD_BUDGET, hashtags=POST_HASHTAGS):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.word_budget = word_budget
+        self.hashtags = hashtags
+        self.done = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.done is None:
+            self.done = [False] * input_ids.shape[0]
+        for row, ids in enumerate(input_ids[:, self.prompt_length:]):
+            if not self.done[row]:
+                text = self.tokenizer.decode(ids, skip_special_tokens=True)
+                self.done[row] = finished_post(text, self.word_budget, self.hashtags)
+        return input_ids.new_tensor(self.done).bool()
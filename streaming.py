@@ -0,0 +1,109 @@
+import json
+import threading
+
+
+class PostStream:
+    """Partial text of one generation, shared between the generating thread and SSE readers."""
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.text = ""
+        self.status = "queued"  # queued / generating / done / cancelled / failed
+        self.cancelled = False
+        self.version = 0
+        self.cond = threading.Condition()
+
+    def update(self, text=None, status=None):
+        with self.cond:
+            if text is not None:
+                self.text = text
+            if status is not None:
+                self.status = status
+            self.version += 1
+            self.cond.notify_all()
+
+    def cancel(self):
+        self.cancelled = True
+        self.update(status="cancelled")
+
+    @property
+    def finished(self):
+        return self.status in ("done", "cancelled", "failed")
+
+    def events(self, keepalive=15):
+        # readers only ever see the latest snapshot, so slow clients skip intermediate tokens
+        seen = -1
+        while True:
+            with self.cond:
+                if self.version == seen:
+                    self.cond.wait(timeout=keepalive)
+                if self.version == seen:
+                    yield ": keep-alive\n\n"
+                    continue
+                seen = self.version
+                text, status = self.text, self.status
+
+            payload = json.dumps({"task_id": self.task_id, "status": status, "text": text})
+            if status in ("done", "cancelled", "failed"):
+                yield f"event: {status}\ndata: {payload}\n\n"
+                return
+            yield f"data: {payload}\n\n"
+
+
+streams = {}
+streams_lock = threading.Lock()
+
+
+def open_stream(task_id):
+    with streams_lock:
+        if task_id not in streams:
+            streams[task_id] = PostStream(task_id)
+        return streams[task_id]
+
+
+def get_stream(task_id):
+    with streams_lock:
+        return streams.get(task_id)
+
+
+def close_stream(task_id, status):
+    with streams_lock:
+        stream = streams.pop(task_id, None)
+    if stream and not stream.finished:
+        stream.update(status=status)
+
+
+class BatchStreamer:
+    """model.generate streamer that decodes every row of a batch into its own PostStream."""
+
+    def __init__(self, tokenizer, streams):
+        self.tokenizer = tokenizer
+        self.streams = streams
+        self.tokens = [[] for _ in streams]
+        self.prompt_seen = False
+
+    def put(self, value):
+        # the first call carries the prompt ids, which are not part of the post
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+
+        for row, ids in enumerate(value.reshape(len(self.streams), -1).tolist()):
+            stream = self.streams[row]
+            if stream.cancelled:
+                continue
+            self.tokens[row].extend(ids)
+            stream.update(self.tokenizer.decode(self.tokens[row], skip_special_tokens=True), "generating")
+
+    def end(self):
+        pass
+
+
+class CancelCriteria:
+    """Stopping criteria that ends decoding for the rows whose stream has been cancelled."""
+
+    def __init__(self, streams):
+        self.streams = streams
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return input_ids.new_tensor([stream.cancelled for stream in self.streams]).bool()
@@ -0,0 +1,13 @@
+"""Generation worker without the HTTP service, for extra inference hosts sharing the database.
+
+    ENABLE_CLAIM_WORKERS=True python worker.py
+"""
+import threading
+
+import llm
+
+if __name__ == "__main__":
+    if not llm.ENABLE_CLAIM_WORKERS:
+        raise SystemExit("Set ENABLE_CLAIM_WORKERS=True in .env to claim tasks from the database")
+    # the claim loop, heartbeat and batch workers all run as daemon threads of llm
+    threading.Event().wait()